@@ -0,0 +1,146 @@
+"""Mirror one Billboard chart into the playlists of many Spotify accounts.
+
+The accounts list has one credential set per account:
+
+    [
+        {"USER_ID": "alice", "CLIENT_ID": "xxx", "CLIENT_SECRET": "xxx"},
+        {"USER_ID": "bob", "CLIENT_ID": "xxx", "CLIENT_SECRET": "xxx", "playlist": "Hot 100"}
+    ]
+
+Every account has its own refresh token (`refresh_token_<USER_ID>.txt`, or
+the storage key in "REFRESH_TOKEN_FILE"), its own saved access token
+(`access_token_<USER_ID>.json`) and its own request scheduler, so one
+account's rate limit never slows down another. All accounts share one HTTP
+session.
+
+The chart is fetched once and its songs are resolved once, with the token
+and request budget of the first account that can authorize; the lookups use
+`market=from_token`, so they need a user token rather than a client
+credentials one. Accounts that cannot authorize are reported as failed and
+the next one resolves instead. The resolved track uris are then pushed
+to every account's playlist, `concurrency` accounts at a time, so each
+extra account only costs its own token refresh, playlist lookup and writes.
+A failing account does not stop the others; the chart is only marked as
+done when every account was updated, so the next run retries the rest.
+
+Example:
+    updateAccounts(json.loads(read_refresh_token("accounts.json")))
+"""
+
+import json
+
+import instrument
+import sae_patch
+from billboard_to_spotify import STATE_FILES, BillboardToSpotify, runForSAE
+from http_session import default_session
+from instrument import span
+from task_pool import map_ordered
+from token_manager import TokenManager
+
+
+def account_files(account):
+    """Return the storage keys of an account's (refresh token, access token)."""
+    user_id = account["USER_ID"]
+    return (account.get("REFRESH_TOKEN_FILE", "refresh_token_%s.txt" % user_id),
+            "access_token_%s.json" % user_id)
+
+
+def account_job(account, session, url=None):
+    """Return a BillboardToSpotify for one account, with its own tokens and scheduler."""
+    job = BillboardToSpotify(user_id=account["USER_ID"], client_secret=account["CLIENT_SECRET"],
+                             client_id=account["CLIENT_ID"],
+                             redirect_uri=account.get("REDIRECT_URI", "https://example.com"),
+                             session=session, url=url, name=account.get("playlist"))
+    job.refresh_token_file, access_token_file = account_files(account)
+    job.tokens = TokenManager(job.refresh_access_token, filename=access_token_file)
+    return job
+
+
+def updateAccounts(accounts, url=None, sync=True, concurrency=4, force=False):
+    """Update the playlist of every account when the chart changed since the last run.
+    Returns {USER_ID: number of tracks, or the error text} per account, {} when the chart is unchanged."""
+    if not accounts:
+        print("Accounts: none to update")
+        return {}
+    session = default_session()
+    jobs = [account_job(account, session, url) for account in accounts]
+    # fetches the chart and keeps its state, which needs no token
+    chart = jobs[0]
+
+    with span("fetch_chart"):
+        if force:
+            songs = chart.billboard_top_100()
+        else:
+            songs = chart.billboard_top_100_if_changed()
+    if songs is None:
+        print("Chart unchanged, playlists left as is")
+        return {}
+
+    results = {}
+    with span("authorize"):
+        resolver = _first_authorized(jobs, results)
+    if resolver is None:
+        print("Accounts: none could authorize")
+        return results
+
+    resolver.load_caches()
+    pending = [job for job in jobs if job.user_id not in results]
+    # long runs outlive the tokens, refresh them before the workers need them
+    for job in pending:
+        job.tokens.start_auto_refresh()
+    try:
+        with span("resolve"):
+            song_uris = resolver.resolve_songs(songs)
+        print("Accounts: %d songs resolved once for %d accounts" % (len(songs), len(jobs)))
+        with span("push"):
+            pushed = map_ordered(lambda job: _push(job, song_uris, sync), pending, concurrency=concurrency)
+    finally:
+        for job in pending:
+            job.tokens.stop_auto_refresh()
+    results.update(zip([job.user_id for job in pending], pushed))
+
+    failed = [job.user_id for job in jobs if not isinstance(results[job.user_id], int)]
+    if failed:
+        print("Accounts: %d of %d failed: %s" % (len(failed), len(jobs), ", ".join(failed)))
+    else:
+        chart.save_chart_state()
+    return results
+
+
+def _first_authorized(jobs, results):
+    # the first job that can authorize; the error text of those that cannot goes into results
+    for job in jobs:
+        try:
+            job.request_user_authorization(interactive=False)
+            return job
+        except Exception as e:
+            print("Account %s: cannot authorize (%s)" % (job.user_id, e))
+            results[job.user_id] = "%s: %s" % (type(e).__name__, e)
+    return None
+
+
+def _push(job, song_uris, sync):
+    # the number of tracks pushed, or the error text of a failed account
+    try:
+        if not job.tokens.valid():
+            job.request_user_authorization(interactive=False)
+        end_point, snapshot_id = job.get_playlist_id()
+        job.push_playlist(end_point, song_uris, snapshot_id, sync)
+    except Exception as e:
+        print("Account %s: failed (%s)" % (job.user_id, e))
+        return "%s: %s" % (type(e).__name__, e)
+    return len([uri for uri in song_uris if uri != None])
+
+
+def updateAccountsForSAE():
+    instrument.recorder.reset()
+    with span("load_state"):
+        state = sae_patch.read_many(STATE_FILES + ["accounts.json"])
+        accounts = json.loads(state["accounts.json"])
+        sae_patch.read_many([key for account in accounts for key in account_files(account)])
+    content = json.loads(state.get("api.json") or "{}")
+    return runForSAE(lambda: updateAccounts(accounts), content.get("REPORT_PATH"))
+
+
+if __name__ == "__main__":
+    print(updateAccountsForSAE())
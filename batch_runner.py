@@ -0,0 +1,145 @@
+"""Mirror several Billboard charts into their own Spotify playlists in one run.
+
+The manifest lists one entry per chart:
+
+    [
+        {"chart": "hot-100", "playlist": "Billboard Hot 100"},
+        {"chart": "billboard-200", "playlist": "Billboard 200"},
+        {"chart": "https://www.billboard.com/charts/country-songs/", "playlist": "Billboard Country"}
+    ]
+
+`chart` is a chart slug on billboard.com or a full chart URL. All charts share
+one token refresh, one HTTP session, one request scheduler, one search cache
+and one track index. Charts are downloaded concurrently, songs that appear on
+several charts are searched once, and the playlists are then updated
+concurrently. Charts that did not change since the last run are skipped, and
+when none changed the run ends before authorizing. A chart that cannot be
+fetched or whose playlist cannot be updated does not stop the others; its
+state is not saved, so the next run retries it.
+
+Example:
+    updateCharts(USER_ID, CLIENT_SECRET, CLIENT_ID, REDIRECT_URI, manifest)
+"""
+
+import json
+
+import instrument
+import sae_patch
+from billboard_to_spotify import STATE_FILES, BillboardToSpotify, runForSAE
+from http_session import default_session
+from instrument import span
+from task_pool import map_ordered
+
+CHART_URL = "https://www.billboard.com/charts/%s/"
+
+
+def chart_url(chart):
+    """Return the URL of a chart given its slug or URL."""
+    if chart.startswith("http"):
+        return chart
+    return CHART_URL % chart.strip("/")
+
+
+def updateCharts(USER_ID, CLIENT_SECRET, CLIENT_ID, REDIRECT_URI, manifest, sync=True, concurrency=4, force=False):
+    """Update one playlist per manifest entry whose chart changed since the last run.
+    Returns {playlist name: number of tracks, or the error text} for the updated and the failed playlists."""
+    session = default_session()
+    main = BillboardToSpotify(user_id=USER_ID, client_secret=CLIENT_SECRET, client_id=CLIENT_ID,
+                              redirect_uri=REDIRECT_URI, session=session)
+
+    jobs = []
+    for entry in manifest:
+        job = BillboardToSpotify(user_id=USER_ID, client_secret=CLIENT_SECRET, client_id=CLIENT_ID,
+                                 redirect_uri=REDIRECT_URI, session=session,
+                                 scheduler=main.scheduler, url=chart_url(entry["chart"]), name=entry["playlist"])
+        jobs.append(job)
+
+    results = {}
+
+    def fetch(job):
+        # the songs, None when unchanged; the error text of a failed chart goes into results
+        try:
+            if force:
+                return job.billboard_top_100()
+            return job.billboard_top_100_if_changed()
+        except Exception as e:
+            print("Chart %s: failed (%s)" % (job.url, e))
+            results[job.name] = "%s: %s" % (type(e).__name__, e)
+            return None
+
+    with span("fetch_charts"):
+        charts = map_ordered(fetch, jobs, concurrency=concurrency)
+    changed = [(job, songs) for job, songs in zip(jobs, charts) if songs is not None]
+    print("Charts: %d of %d changed, %d failed" % (len(changed), len(jobs), len(results)))
+    if not changed:
+        return results
+
+    main.load_caches()
+    with span("authorize"):
+        main.request_user_authorization()
+    for job, _ in changed:
+        job.tokens = main.tokens
+    # long batches outlive the token, refresh it before the workers need it
+    main.tokens.start_auto_refresh()
+    try:
+        results.update(_update_changed(main, changed, sync, concurrency))
+    finally:
+        main.tokens.stop_auto_refresh()
+    failed = [name for name, result in sorted(results.items()) if not isinstance(result, int)]
+    if failed:
+        print("Charts: %d of %d failed: %s" % (len(failed), len(jobs), ", ".join(failed)))
+    return results
+
+
+def _update_changed(main, changed, sync, concurrency):
+    # every song is searched once, however many charts it is on
+    unique = []
+    seen = set()
+    for _, songs in changed:
+        for song in songs:
+            if song not in seen:
+                seen.add(song)
+                unique.append(song)
+    print("Charts: %d songs, %d unique" % (sum(len(songs) for _, songs in changed), len(unique)))
+    with span("resolve"):
+        uris = dict(zip(unique, main.resolve_songs(unique)))
+
+    with span("get_playlists"):
+        playlists = main.get_playlists()
+
+    def update(args):
+        # the number of tracks pushed, or the error text of a failed playlist
+        job, songs = args
+        song_uris = [uris[song] for song in songs]
+        try:
+            end_point, snapshot_id = job.get_playlist_id(playlists)
+            job.push_playlist(end_point, song_uris, snapshot_id, sync)
+            job.save_chart_state()
+        except Exception as e:
+            print("Chart %s: failed (%s)" % (job.url, e))
+            return "%s: %s" % (type(e).__name__, e)
+        return len([uri for uri in song_uris if uri != None])
+
+    with span("update_playlists"):
+        counts = map_ordered(update, changed, concurrency=concurrency)
+    return dict(zip([job.name for job, _ in changed], counts))
+
+
+def updateChartsForSAE():
+    instrument.recorder.reset()
+    with span("load_state"):
+        state = sae_patch.read_many(STATE_FILES + ["charts.json"])
+    content = json.loads(state["api.json"])
+    manifest = json.loads(state["charts.json"])
+
+    USER_ID = content['USER_ID']
+    CLIENT_ID = content["CLIENT_ID"]
+    CLIENT_SECRET = content["CLIENT_SECRET"]
+    REDIRECT_URI = 'https://example.com'
+
+    return runForSAE(lambda: updateCharts(USER_ID, CLIENT_SECRET, CLIENT_ID, REDIRECT_URI, manifest),
+                     content.get("REPORT_PATH"))
+
+
+if __name__ == "__main__":
+    print(updateChartsForSAE())
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""Benchmark the chart_parser backends on saved Billboard chart pages.
+
+Usage:
+    python bench_chart_parser.py [page.html ...] [--synthetic] [--repeat N]
+
+Save a page with e.g. `curl -o hot-100.html https://www.billboard.com/charts/hot-100/`.
+Without pages the chart page in fixtures/hot-100.html is used; --synthetic
+adds a generated page of about 2 MB with 100 rows. For every page the best
+time per backend is printed, and the formatted songs of each backend are
+checked against the "soup" backend; test_chart_parser.py checks the same on
+the fixture.
+"""
+
+import io
+import os
+import sys
+import time
+
+from chart_parser import BACKENDS, format_song
+from cli import pop_option
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "hot-100.html")
+
+ROW = u"""<div class="o-chart-results-list-row-container">
+<ul class="o-chart-results-list-row //">
+<li class="o-chart-results-list__item"><span class="c-label">%(rank)d</span></li>
+<li class="lrv-u-width-100p"><ul><li class="o-chart-results-list__item // lrv-u-flex-grow-1">
+<img src="/img/%(rank)d.jpg" alt="">
+<h3 id="title-of-a-story" class="c-title a-no-trucate">
+
+\t\n\t%(title)s\n</h3>
+<span class="c-label a-no-trucate">
+\t\n\t%(artist)s\n</span>
+</li></ul></li></ul></div>
+"""
+
+
+def make_chart_html(rows=100, filler_kb=2000):
+    """Return a synthetic chart page shaped like billboard.com's."""
+    parts = [u"<!DOCTYPE html><html><head><title>Billboard Hot 100</title>"]
+    script = u"<script>var data = %s;</script>\n" % (u"[" + u"1," * 500 + u"0]")
+    parts.extend([script] * (filler_kb * 1024 // len(script) // 2))
+    parts.append(u"</head><body><div class=\"chart-results-list\">")
+    for rank in range(1, rows + 1):
+        parts.append(ROW % {
+            "rank": rank,
+            "title": u"Song Number %d &amp; Friends" % rank,
+            "artist": u"Artist %d Featuring Guest %d" % (rank, rank % 7),
+        })
+    parts.append(u"</div>")
+    parts.extend([u"<div class=\"footer\"><p>%s</p></div>\n" % (u"x" * 1000)] * (filler_kb // 2))
+    parts.append(u"</body></html>")
+    return u"".join(parts)
+
+
+def bench(html, repeat=5):
+    """Return {backend: (best seconds, formatted songs)}."""
+    results = {}
+    for name, parse in sorted(BACKENDS.items()):
+        best = None
+        for _ in range(repeat):
+            begin = time.time()
+            rows = parse(html)
+            elapsed = time.time() - begin
+            best = elapsed if best is None else min(best, elapsed)
+        results[name] = (best, [format_song(title, artist) for title, artist in rows])
+    return results
+
+
+def main(argv):
+    argv = list(argv)
+    repeat = int(pop_option(argv, "--repeat", "5"))
+    synthetic = "--synthetic" in argv
+    if synthetic:
+        argv.remove("--synthetic")
+    pages = [(path, io.open(path, encoding="utf-8").read()) for path in argv or [FIXTURE]]
+    if synthetic:
+        pages.append(("synthetic", make_chart_html()))
+    for label, html in pages:
+        results = bench(html, repeat)
+        reference = results["soup"][1]
+        print("%s: %d KB, %d rows" % (label, len(html) // 1024, len(reference)))
+        for name in sorted(results, key=lambda n: results[n][0]):
+            seconds, songs = results[name]
+            print("  %-8s %8.1f ms  %5.1fx  %s" % (
+                name, seconds * 1000, results["soup"][0] / seconds,
+                "same rows" if songs == reference else "ROWS DIFFER"))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""Benchmark whole update runs offline against `mock_services`.
+
+Usage:
+    python bench_pipeline.py [scenario ...] [--chart page.html] [--synthetic] [--latency S]
+        [--errors P] [--429 P] [--not-found P] [--workers N] [--rate R]
+        [--tracks N] [--oss-mb N] [--seed N] [--verbose]
+
+Scenarios (default: all of them, in this order):
+    oss             put_object/get_object of a small object, then
+                    put_object_stream/get_object_stream of --oss-mb MB
+    song_uris       fetch and parse the chart, search every song
+    clear_playlist  remove --tracks tracks from a playlist
+    update          updateBillboard twice: a cold run against empty storage,
+                    then a forced warm run with the song cache and token kept
+
+Every https:// request goes to a local mock server through the shared
+session, and sae_patch storage goes to the mock OSS bucket. --latency adds
+that many seconds to every response; --errors and --429 are the fractions of
+Spotify Web API calls answered with 503 and 429. The chart is the page in
+fixtures/hot-100.html, the same one test_chart_parser checks, or a page
+passed with --chart (e.g. saved with
+`curl -o hot-100.html https://www.billboard.com/charts/hot-100/`); --synthetic
+uses the generated page from bench_chart_parser instead.
+
+song_uris and clear_playlist use a scheduler with --workers and --rate; the
+update runs use the scheduler settings updateBillboard itself uses. For every
+scenario the wall time, the requests the client sent (retries included), the
+requests per route the server saw, the faults injected and the peak RSS of
+the process so far are printed; run one scenario per process to compare
+peak memory. The pipeline's own output is hidden unless --verbose is given.
+"""
+
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import http_session
+import instrument
+import oss_minimal
+import sae_patch
+from bench_chart_parser import FIXTURE, make_chart_html
+from billboard_to_spotify import BillboardToSpotify, updateBillboard
+from mock_services import MockServices, track_uri
+from rate_limit import RequestScheduler
+
+SCENARIOS = ["oss", "song_uris", "clear_playlist", "update"]
+USER_ID = "bench-user"
+BUCKET = "bench-bucket"
+OSS_ENDPOINT = "oss-bench.aliyuncs.com"
+OPTIONS = {
+    "--chart": FIXTURE,
+    "--latency": 0.0,
+    "--errors": 0.0,
+    "--429": 0.0,
+    "--not-found": 0.0,
+    "--workers": 10,
+    "--rate": 10.0,
+    "--tracks": 500,
+    "--oss-mb": 32,
+    "--seed": 0,
+    "--synthetic": False,
+    "--verbose": False,
+}
+
+
+def peak_rss_mb():
+    """Return the peak resident set size of the process in MB, None when unknown."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024.0 * 1024.0) if sys.platform == "darwin" else peak / 1024.0
+
+
+def bench_oss(services, options):
+    client = oss_minimal.OSSClient(BUCKET, "AKIDBENCH", "bench-secret", OSS_ENDPOINT)
+    small = b"{}" * 2048
+    for i in range(20):
+        client.put_object("bench/small-%d.json" % i, small)
+        client.get_object("bench/small-%d.json" % i)
+    size = options["--oss-mb"] * 1024 * 1024
+    source = io.BytesIO(os.urandom(1024 * 1024) * options["--oss-mb"])
+    client.put_object_stream("bench/large.bin", source, workers=options["--workers"])
+    target = bytearray(size)
+    client.get_object_stream("bench/large.bin", target, workers=options["--workers"])
+    if bytes(target) != source.getvalue():
+        raise SystemExit("oss: downloaded object differs")
+    return "%d MB up and down" % options["--oss-mb"]
+
+
+def _playlist_client(services, options):
+    session = http_session.default_session()
+    scheduler = RequestScheduler(session, rate=options["--rate"], burst=options["--rate"] * 2,
+                                 max_concurrency=options["--workers"])
+    client = BillboardToSpotify(USER_ID, "client-id", "client-secret", "https://example.com",
+                                session=session, scheduler=scheduler)
+    client.workers = options["--workers"]
+    client.access_token = "mock-access-token"
+    return client
+
+
+def bench_song_uris(services, options):
+    uris = _playlist_client(services, options).song_uris()
+    return "%d songs, %d found" % (len(uris), len([uri for uri in uris if uri]))
+
+
+def bench_clear_playlist(services, options):
+    uris = [track_uri("bench %d" % i) for i in range(options["--tracks"])]
+    href, snapshot_id = services.add_playlist(USER_ID, "Bench Clear", uris)
+    _playlist_client(services, options).clear_playlist(href, snapshot_id)
+    left = len(services.playlist_uris(href))
+    if left:
+        raise SystemExit("clear_playlist: %d tracks left" % left)
+    return "%d tracks removed" % len(uris)
+
+
+def bench_update(services, options, force):
+    updateBillboard(USER_ID, "client-secret", "client-id", "https://example.com", force=force)
+    sae_patch.flush()
+    return "%d tracks in playlist" % len(services.playlist_uris(_playlist_href(services)))
+
+
+def _playlist_href(services):
+    for playlist_id, playlist in services.playlists.items():
+        if playlist["name"] == BillboardToSpotify.name and playlist["owner"] == USER_ID:
+            return "https://api.spotify.com/v1/playlists/%s/tracks" % playlist_id
+    raise SystemExit("update: playlist missing")
+
+
+class _Discard(object):
+    def write(self, text):
+        pass
+
+    def flush(self):
+        pass
+
+
+def run(name, func, services, options, *args):
+    services.reset_counts()
+    instrument.recorder.reset()
+    stdout = sys.stdout
+    if not options["--verbose"]:
+        sys.stdout = _Discard()
+    begin = time.time()
+    try:
+        detail = func(services, options, *args)
+    finally:
+        elapsed = time.time() - begin
+        sys.stdout = stdout
+    report = instrument.recorder.report()
+    sent = sum(stats["count"] for stats in report["requests"].values())
+    peak = peak_rss_mb()
+    print("%s: %.2f s, %d requests sent, %s, peak RSS %s" % (
+        name, elapsed, sent, detail, "%.1f MB" % peak if peak is not None else "unknown"))
+    for route, count in sorted(services.counts.items(), key=lambda item: -item[1]):
+        print("  %5d  %s" % (count, route))
+    if services.faults["429"] or services.faults["503"]:
+        print("  injected: %d x 429, %d x 503" % (services.faults["429"], services.faults["503"]))
+
+
+def parse_options(argv):
+    options = dict(OPTIONS)
+    scenarios = []
+    i = 0
+    while i < len(argv):
+        if argv[i] in ("--synthetic", "--verbose"):
+            options[argv[i]] = True
+            i += 1
+        elif argv[i] in options:
+            default = OPTIONS[argv[i]]
+            value = argv[i + 1]
+            options[argv[i]] = type(default)(value) if default is not None else value
+            i += 2
+        elif argv[i] in SCENARIOS:
+            scenarios.append(argv[i])
+            i += 1
+        else:
+            raise SystemExit("unknown argument %s\n%s" % (argv[i], __doc__))
+    return scenarios or SCENARIOS, options
+
+
+def main(argv):
+    scenarios, options = parse_options(argv)
+    if options["--synthetic"]:
+        chart = make_chart_html()
+    else:
+        chart = io.open(options["--chart"], encoding="utf-8").read()
+    services = MockServices(chart, latency=options["--latency"], error_rate=options["--errors"],
+                            rate_limit_rate=options["--429"], not_found_rate=options["--not-found"],
+                            seed=options["--seed"]).start()
+    http_session.set_default_session(services.session(pool_maxsize=max(10, options["--workers"])))
+
+    cache_dir = tempfile.mkdtemp(prefix="bench_pipeline_")
+    client = oss_minimal.OSSClient(BUCKET, "AKIDBENCH", "bench-secret", OSS_ENDPOINT)
+    sae_patch.store = sae_patch.TieredStore(client_factory=lambda: client, cache_dir=cache_dir)
+    client.put_object("refresh_token.txt", b"mock-refresh-token")
+    # last week's chart, so the first update replaces every track
+    services.add_playlist(USER_ID, BillboardToSpotify.name, [track_uri("last week %d" % i) for i in range(100)])
+
+    print("chart: %d KB; latency %.3f s, errors %.2f, 429 %.2f, workers %d, rate %.1f/s" % (
+        len(chart) // 1024, options["--latency"], options["--errors"], options["--429"],
+        options["--workers"], options["--rate"]))
+    try:
+        for name in scenarios:
+            if name == "oss":
+                run(name, bench_oss, services, options)
+            elif name == "song_uris":
+                run(name, bench_song_uris, services, options)
+            elif name == "clear_playlist":
+                run(name, bench_clear_playlist, services, options)
+            elif name == "update":
+                run("update (cold)", bench_update, services, options, False)
+                run("update (warm)", bench_update, services, options, True)
+    finally:
+        services.stop()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -2,29 +2,40 @@
 import os
 import base64
 import datetime 
-import time
 import json
-from bs4 import BeautifulSoup
-import requests
+import hashlib
 import threading
+import time
+import instrument
 import sae_patch
+from chart_parser import format_song, parse_chart
+from http_session import default_session
+from instrument import span
+from rate_limit import RequestScheduler
+from task_pool import imap_ordered, map_ordered
+from token_manager import TokenManager
+
+# playlist_sync, playlist_writer, song_cache and song_match are imported where they are used,
+# so a run that finds the chart unchanged never loads them
 
 read_refresh_token = sae_patch.read_refresh_token
 write_refresh_token = sae_patch.write_refresh_token
 
-try:
-    from queue import Queue
-except:
-    from Queue import Queue
+# chart_state.json holds every chart, so concurrent saves must not interleave
+chart_state_lock = threading.Lock()
 
-class BillboardToSpotify:
+class BillboardToSpotify(object):
 
     name = "Billboard Hot 100"
-    description = "The unofficial Billboard Hot 100 playlist, updated in %s. Reference: https://www.billboard.com/charts/hot-100/" % datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M%Z')
+    _description = None
+    # base64 of billboard.png, read once per process
+    _cover = None
 
-    def __init__(self, user_id, client_id, client_secret, redirect_uri):
+    def __init__(self, user_id, client_id, client_secret, redirect_uri, cache=None, session=None, scheduler=None, url=None, name=None, index=None, tokens=None, aliases=None):
 
-        self.url ="https://www.billboard.com/charts/hot-100/"
+        self.url = url or "https://www.billboard.com/charts/hot-100/"
+        if name:
+            self.name = name
         self.user_id = user_id
         self.client_id = client_id
         self.client_secret = client_secret
@@ -32,33 +43,92 @@ class BillboardToSpotify:
         self.endpoint = 'https://accounts.spotify.com/authorize'
         self.scope = 'playlist-modify-private playlist-read-private playlist-modify-public ugc-image-upload'
         self.token_endpoint  ='https://accounts.spotify.com/api/token'
-        self.access_token = ""
-
-    def request_user_authorization(self):
-        """ Two-step function returns access_code to use in the next steps.Go to link in the terminal, accept authorization
-        and copy the code (you should find in the "code=" part) in url.Then paste the code in terminal"""
+        # storage key of the refresh token, one per account when several accounts share a process
+        self.refresh_token_file = "refresh_token.txt"
+        self.tokens = tokens or TokenManager(self.refresh_access_token)
+        self.cache = cache
+        # title/artist -> track uri of every song found once, kept without expiry
+        self.index = index
+        # song_match.AliasTable of search overrides
+        self.aliases = aliases
+        # most track index entries kept, the least recently used are dropped first
+        self.index_entries = 20000
+        self.session = session or default_session()
+        # song_uris: parallel searches and the longest a single search may take
+        self.workers = 10
+        self.task_timeout = 60
+        self.timeout = 15
+        # chart_parser backend for billboard_top_100
+        self.parser = "stream"
+        self.chart_state = None
+        # validators and hash of self.url as last loaded or saved, so a long-running process reads them once
+        self.saved_chart_state = None
+        self.scheduler = scheduler or RequestScheduler(self.session, max_concurrency=self.workers, timeout=self.timeout)
+
+    @property
+    def description(self):
+        """playlist description with the time it was first asked for"""
+        if self._description is None:
+            self._description = "The unofficial %s playlist, updated in %s. Reference: %s" % (self.name, datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M%Z'), self.url)
+        return self._description
+
+    @description.setter
+    def description(self, description):
+        self._description = description
+
+    @property
+    def access_token(self):
+        """current access token, refreshed by the token manager shortly before it expires"""
+        return self.tokens.get()
+
+    @access_token.setter
+    def access_token(self, token):
+        self.tokens.set(token, save=False)
+
+    def _basic_auth_headers(self):
         concat = self.client_id+':'+self.client_secret
         auth = base64.b64encode(concat.encode('ascii')).decode('ascii')
-        headers = {
+        return {
             'Authorization': "Basic " + auth,
             'Content-Type': "application/x-www-form-urlencoded"
         }
-        
-        token = read_refresh_token("refresh_token.txt")
-        if len(token) > 0:
-            data = {
-                'grant_type': 'refresh_token',
-                'refresh_token': token,
-            }
 
-            r = requests.post(self.token_endpoint, headers=headers, data=data)
-            print("Response: %d refresh" % r.status_code)
-            if r.status_code == 200:
-                j = r.json()
-                self.access_token= j['access_token']
-                print("Token: %s" % self.access_token)
-                write_refresh_token(j['refresh_token'] if 'refresh_token' in j else token, "refresh_token.txt")
-                return
+    def refresh_access_token(self):
+        """exchanges the saved refresh token for an access token. Returns (access_token, expires_in), or None"""
+        token = read_refresh_token(self.refresh_token_file)
+        if len(token) == 0:
+            return None
+        data = {
+            'grant_type': 'refresh_token',
+            'refresh_token': token,
+        }
+
+        # a repeated refresh grant only returns another access token
+        r = self.scheduler.request("POST", self.token_endpoint, headers=self._basic_auth_headers(), data=data,
+                                   retry_errors=True)
+        print("Response: %d refresh" % r.status_code)
+        if r.status_code != 200:
+            return None
+        j = r.json()
+        if j.get('refresh_token', token) != token:
+            write_refresh_token(j['refresh_token'], self.refresh_token_file)
+        return j['access_token'], j.get('expires_in', 3600)
+
+    def request_user_authorization(self, interactive=True):
+        """ Two-step function returns access_code to use in the next steps.Go to link in the terminal, accept authorization
+        and copy the code (you should find in the "code=" part) in url.Then paste the code in terminal.
+        Skipped while the saved access token is valid; without interactive, raises instead of asking for a code"""
+        if self.tokens.load().valid():
+            print("Token: saved, expires in %ds" % self.tokens.expires_in())
+            return
+
+        refreshed = self.refresh_access_token()
+        if refreshed:
+            self.tokens.set(*refreshed)
+            print("Token: %s" % self.access_token)
+            return
+        if not interactive:
+            raise Exception("no valid refresh token in %s" % self.refresh_token_file)
         
         params = {
             'response_type': 'code',
@@ -67,7 +137,7 @@ class BillboardToSpotify:
             'redirect_uri': self.redirect_uri,
         }
 
-        r = requests.get(self.endpoint, params=params)
+        r = self.session.get(self.endpoint, params=params)
         print("Response: %d account" % r.status_code)
         print(r.url)
         code = raw_input("paste code here: ")
@@ -78,32 +148,87 @@ class BillboardToSpotify:
             'redirect_uri': self.redirect_uri
         }
 
-        r = requests.post(self.token_endpoint, headers=headers, data=data)
+        r = self.scheduler.request("POST", self.token_endpoint, headers=self._basic_auth_headers(), data=data)
         print("Response: %d new_token" % r.status_code)
         r = r.json()
-        self.access_token= r['access_token']
-        write_refresh_token(r['refresh_token'], "refresh_token.txt")
+        write_refresh_token(r['refresh_token'], self.refresh_token_file)
+        self.tokens.set(r['access_token'], r.get('expires_in', 3600))
 
 ########################## Picking hot 100 song for a certain date from Billboard#######################################
+    def _get_chart(self, headers=None):
+        begin = time.time()
+        respond = self.session.get(self.url, headers=headers, timeout=self.timeout)
+        instrument.observe(instrument.endpoint_name("GET", self.url), time.time() - begin, respond.status_code,
+                           bytes_received=len(respond.content))
+        print("Response: %d billboard" % respond.status_code)
+        return respond
+
+    def chart_songs(self, respond):
+        """returns the formatted songs of a chart response. Raises for error pages and for pages without rows,
+        so neither is ever taken for an empty chart"""
+        respond.raise_for_status()
+        formatted_songs = [format_song(title, artist) for title, artist in parse_chart(respond.text, self.parser)]
+        if not formatted_songs:
+            raise Exception("no chart rows in %s" % self.url)
+        return formatted_songs
+
     def billboard_top_100(self):
         """ takes top 100 songs for a certain date from the Billboard website and format songs list for using spotify api. Returns formatted song list """
-        url = self.url
-        respond  =requests.get(url)
-        print("Response: %d billboard" % respond.status_code)
-        website_html = respond.text
-        soup = BeautifulSoup(website_html, "html.parser")
-        song_names_spans = soup.find_all("div" , class_="o-chart-results-list-row-container")
-        song_itmes = [row.find("h3", id="title-of-a-story") for row in song_names_spans]
-        song_names = [song.getText() + "  artist:" + song.find_next_sibling("span").getText() for song in song_itmes]
-        formatted_songs= [songs
-                          .replace('\t','')
-                          .replace('\n','')
-                          .replace('Featuring', ' ')
-                          .replace('  ', ' ') 
-                          .replace('4x4xU', u'4×4×U')
-                          for songs in song_names]
+        respond = self._get_chart()
+        formatted_songs = self.chart_songs(respond)
+        self.chart_state = self._chart_state(respond, formatted_songs)
+        return formatted_songs
+
+    def _chart_state(self, respond, formatted_songs):
+        """returns the validators and song hash that save_chart_state keeps for a chart response"""
+        return {
+            'etag': respond.headers.get('ETag'),
+            'last_modified': respond.headers.get('Last-Modified'),
+            'hash': hashlib.sha1(u"\n".join(formatted_songs).encode("utf-8")).hexdigest(),
+        }
+
+    def load_chart_state(self):
+        """returns the validators and song hash saved for every chart url"""
+        try:
+            content = read_refresh_token("chart_state.json")
+            return json.loads(content) if content else {}
+        except Exception as e:
+            print("Chart state: cannot load (%s)" % e)
+            return {}
+
+    def billboard_top_100_if_changed(self):
+        """like billboard_top_100, but returns None when the chart is unchanged since the last save_chart_state.
+        Sends the saved ETag/Last-Modified so an unchanged page costs a 304, and compares a hash of the songs otherwise"""
+        if self.saved_chart_state is None:
+            self.saved_chart_state = self.load_chart_state().get(self.url, {})
+        state = self.saved_chart_state
+        headers = {}
+        if state.get('etag'):
+            headers['If-None-Match'] = state['etag']
+        if state.get('last_modified'):
+            headers['If-Modified-Since'] = state['last_modified']
+        respond = self._get_chart(headers)
+        if respond.status_code == 304:
+            return None
+        formatted_songs = self.chart_songs(respond)
+        self.chart_state = self._chart_state(respond, formatted_songs)
+        if self.chart_state['hash'] == state.get('hash'):
+            if self.chart_state != state:
+                # remember the new validators so the next check can get a 304
+                self.save_chart_state()
+            return None
         return formatted_songs
 
+    def save_chart_state(self):
+        """saves the chart seen by billboard_top_100 or billboard_top_100_if_changed, call it once the playlist is updated"""
+        if self.chart_state is None:
+            return
+        with chart_state_lock:
+            state = self.load_chart_state()
+            state[self.url] = self.chart_state
+            write_refresh_token(json.dumps(state), "chart_state.json")
+        self.saved_chart_state = self.chart_state
+
     def creating_playlist(self):
         """creates a private Spotify playlist"""
 
@@ -118,7 +243,7 @@ class BillboardToSpotify:
             "description": self.description,
             "public": True
         }
-        response = requests.post(playlist_endpoint, headers=headers, json=data)
+        response = self.scheduler.request("POST", playlist_endpoint, headers=headers, json=data)
         print("Response: %d creating_playlist" % response.status_code)
         r = response.json()
         if response.status_code > 201:
@@ -126,146 +251,308 @@ class BillboardToSpotify:
         return r['tracks']['href']
     
     def query_song_uri(self, song):
+        """searches a song and returns the uri of the best scoring result, None when nothing matches well.
+        Tries the alias query first, then the song, then the title alone"""
+        from song_match import ACCEPT_SCORE, MIN_SCORE, best_match, rewrite, split_song
+
         print("Query: %s" % song)
-        # limit 1 result in wired results
         headers = {"Content-Type": "application/json", "Authorization": "Bearer " + self.access_token}
-        songuris_endpoint = 'https://api.spotify.com/v1/search?'
-        retry = 3
-        query = song
-        while retry > 0:
-            try:
-                params = {
-                    "q": query,
-                    "type": "track",
-                    "limit": 10
-                }
-                response = requests.get(songuris_endpoint, params=params, headers = headers)
-                
-                # print(response.json()["tracks"])
-                tracks = response.json()["tracks"]
-                if tracks["total"] < 1:
-                    # no result, retry without artist
-                    if retry == 3:
-                        query = song[0:song.find('artist:')]
-                    retry -= 1
-                    print("Retry: " + query)
-                    continue
-                uris = tracks['items'][0]['uri']
-                print("Found: " + tracks['items'][0]['name'])
-                return uris
-            except Exception as e:
-                if retry > 0:
-                    retry -= 1
-                    time.sleep(2)
-                    print("Retry: " + query)
-                    continue
-                raise e
+        songuris_endpoint = 'https://api.spotify.com/v1/search'
+        title, artist = split_song(song)
+        alias = self.aliases.get(song) if self.aliases is not None else None
+        queries = [alias['query']] if alias and alias.get('query') else []
+        queries.append(rewrite(song))
+        if 'artist:' in song:
+            # no good result, retry without artist
+            queries.append(rewrite(title))
+        best = (0.0, None, None)
+        for i, query in enumerate(queries):
+            if query in queries[:i]:
+                continue
+            params = {
+                "q": query,
+                "type": "track",
+                "limit": 10
+            }
+            # 429s and server errors are retried by the scheduler
+            response = self.scheduler.request("GET", songuris_endpoint, params=params, headers = headers)
+            if response.status_code != 200:
+                print("Response: %d search" % response.status_code)
+                response.raise_for_status()
+            tracks = response.json()["tracks"]
+            if tracks["total"] < 1 or len(tracks["items"]) == 0:
+                print("Not found: " + query)
+                continue
+            score, track = best_match(title, artist, tracks['items'])
+            if score > best[0]:
+                best = (score, track, query)
+            if score >= ACCEPT_SCORE:
+                break
+            print("Weak match %.2f: %s" % (score, query))
+        score, track, query = best
+        if track is None or score < MIN_SCORE:
+            print("Not found: " + song)
+            return None
+        print("Found: %s (%.2f)" % (track['name'], score))
+        if self.aliases is not None and query != rewrite(song) and score >= ACCEPT_SCORE:
+            # matched well on an alias or fallback query, search with it first next time
+            self.aliases.learn(song, query, track['uri'])
+        return track['uri']
 
 # ########################################## Finding songs uris###########################################################
-    def song_uris(self):
-        """reachs uri parameters of songs and return a uris array ready for use in the next steps"""
-        formatted_songs = self.billboard_top_100()
+    def load_caches(self):
+        """loads the song cache, the track index and the aliases from storage, unless they are loaded already"""
+        from song_cache import SongCache
+        from song_match import AliasTable
 
-        result = {}
-        jobs = Queue()
-
-        def do_stuff(q):
-            while not q.empty():
-                value = q.get()
-                uri = self.query_song_uri(value)
-                result[value] = uri
-                q.task_done()
+        if self.cache is not None:
+            return
+        with span("load_cache"):
+            # one concurrent round trip, the loads below are then served from the storage cache
+            sae_patch.read_many(CACHE_FILES)
+            self.cache = SongCache("song_cache.json").load()
+            self.index = SongCache("track_index.json", ttl=None, max_entries=self.index_entries).load()
+            self.aliases = AliasTable("aliases.json").load()
 
-        for i in formatted_songs:
-            jobs.put(i)
+    def song_uris(self):
+        """reachs uri parameters of songs and return a uris array ready for use in the next steps"""
+        return self.resolve_songs(self.billboard_top_100())
 
-        for i in range(10):
-            worker = threading.Thread(target=do_stuff, args=(jobs,))
-            worker.start()
+    def confirm_tracks(self, uris):
+        """looks up known track uris with /v1/tracks, at most 50 per request.
+        Returns the playable uri for every given uri in order, None for tracks no longer available"""
+        headers = {"Content-Type": "application/json", "Authorization": "Bearer " + self.access_token}
+        tracks_endpoint = 'https://api.spotify.com/v1/tracks'
 
-        jobs.join()
+        def lookup(chunk):
+            params = {
+                "ids": ",".join(uri.split(':')[-1] for uri in chunk),
+                "market": "from_token",
+            }
+            response = self.scheduler.request("GET", tracks_endpoint, params=params, headers=headers)
+            print("Response: %d tracks lookup" % response.status_code)
+            if response.status_code != 200:
+                response.raise_for_status()
+            return [track['uri'] if track and track.get('is_playable', True) else None
+                    for track in response.json()['tracks']]
+
+        n = 50
+        chunks = [uris[i:i + n] for i in range(0, len(uris), n)]
+        confirmed = []
+        for found in map_ordered(lookup, chunks, concurrency=self.workers, task_timeout=self.task_timeout):
+            confirmed.extend(found)
+        return confirmed
+
+    def resolve_songs(self, formatted_songs):
+        """returns the uri of every formatted song in order. Songs missing from the cache but in the track index
+        are confirmed with batched track lookups, only the rest are searched"""
+        result = {}
+        pending = []
+        seen = set()
+        for song in formatted_songs:
+            if self.cache is not None:
+                found, uri = self.cache.lookup(song)
+                if found:
+                    result[song] = uri
+                    continue
+            if song not in seen:
+                seen.add(song)
+                pending.append(song)
+        if self.cache is not None:
+            print("Cache: %d hits, %d to query" % (len(formatted_songs) - len(pending), len(pending)))
+
+        known = []
+        for song in pending:
+            found, uri = self.index.lookup(song) if self.index is not None else (False, None)
+            if not (found and uri) and self.aliases is not None:
+                uri = (self.aliases.get(song) or {}).get('uri')
+            if uri:
+                known.append((song, uri))
+        if known:
+            with span("confirm_tracks"):
+                confirmed = self.confirm_tracks([uri for _, uri in known])
+            for (song, _), uri in zip(known, confirmed):
+                if uri:
+                    result[song] = uri
+                elif self.aliases is not None:
+                    self.aliases.forget(song)
+            pending = [song for song in pending if song not in result]
+            print("Index: %d of %d confirmed, %d to search" % (len([uri for uri in confirmed if uri]), len(known), len(pending)))
+
+        with span("search"):
+            uris = map_ordered(self.query_song_uri, pending, concurrency=self.workers, task_timeout=self.task_timeout)
+        for song, uri in zip(pending, uris):
+            result[song] = uri
+            if self.index is not None and uri:
+                self.index.put(song, uri)
+        if self.cache is not None:
+            for song in seen:
+                self.cache.put(song, result[song])
+            self.cache.save()
+        if self.index is not None:
+            self.index.save()
+        if self.aliases is not None:
+            self.aliases.save()
         return [result[song] for song in formatted_songs]
 
+# ############################ Paging ####################################################################################
+    def paginate(self, end_point, params=None, limit=100, label="page"):
+        """yields the items of a paged endpoint in order. The first page tells the total,
+        the remaining pages are then fetched concurrently with `limit` items each"""
+        headers = {"Content-Type": "application/json",
+                   "Authorization": "Bearer " + self.access_token}
+
+        def page(offset):
+            page_params = dict(params or {}, limit=limit, offset=offset)
+            r = self.scheduler.request("GET", end_point, headers=headers, params=page_params)
+            print("Response: %d %s" % (r.status_code, label))
+            if r.status_code != 200:
+                r.raise_for_status()
+            return r.json()
+
+        first = page(0)
+        for item in first['items']:
+            yield item
+        total = first.get('total', 0)
+        for j in imap_ordered(page, range(limit, total, limit), concurrency=self.workers, task_timeout=self.task_timeout):
+            for item in j['items']:
+                yield item
+
 # ############################GET PLAYLIST ID############################################################################
-    def get_playlist_id(self):
-        """returns an endpoint to use in the next function which is to add all songs to the playlist"""
+    def iter_playlists(self):
+        """yields the playlists of the user, 50 per page (the API maximum)"""
         self.base_url = 'https://api.spotify.com/v1/users/%s/playlists' % self.user_id
-        params = {
-            "limit": 30,
-            "offset": 0,
-        }
-
-        headers_playlist = {"Content-Type": "application/json",
-                            "Authorization": "Bearer " + self.access_token}
-        response_playlist = requests.get(self.base_url, params=params, headers = headers_playlist)
-        print("Response: %d get_playlist_id" % response_playlist.status_code)
-        response_playlist = response_playlist.json()
-        for item in response_playlist['items']:
+        return self.paginate(self.base_url, limit=50, label="get_playlists")
+
+    def get_playlists(self):
+        """returns the playlists of the user"""
+        return list(self.iter_playlists())
+
+    def get_playlist_id(self, playlists=None):
+        """returns an endpoint to use in the next function which is to add all songs to the playlist.
+        playlists from get_playlists can be passed in to avoid fetching them again"""
+        if playlists is None:
+            # stops fetching pages once the playlist is found
+            playlists = self.iter_playlists()
+        for item in playlists:
             if item['name'] == self.name and item['owner']['id'] == self.user_id:
                 return (item['tracks']['href'], item['snapshot_id'])
         return (None, None)
 
 
 # ######################################## Adding songs to list ##########################################################
+    def playlist_writer(self, end_point):
+        """returns a PlaylistWriter for chunked, retried writes to the playlist behind end_point"""
+        from playlist_writer import PlaylistWriter
+
+        return PlaylistWriter(self.scheduler, end_point, lambda: self.access_token)
+
     def adding_playlist(self, end_point, song_uris):
-        """adds songs from Billboard website to Spotify playlist just created"""
-        # filter
-        uris = list(filter(lambda x: x != None, song_uris))
-        body = {
-            "uris": uris,
-            "position": 0,
-        }
-        print(len(uris))
-        headers = {
-            "Content-Type": "application/json", 
-            "Authorization": "Bearer " + self.access_token
-        }
-        response = requests.post(end_point, headers = headers, json=body)
-        print("Response: %s adding_playlist" % response.status_code)
-        if response.status_code >= 400:
-            print(uris)
-            print(response.json())
+        """adds songs from Billboard website to Spotify playlist just created, in order at the top.
+        Returns a playlist_writer.WriteResult"""
+        result = self.playlist_writer(end_point).add((uri for uri in song_uris if uri != None), position=0)
+        print(result.added)
+        if not result.ok:
+            print(result)
+        return result
 
 # ######################################## Remove songs from list ##########################################################
-    def clear_playlist(self, end_point, snapshot_id):
-        """get songs from Billboard website to Spotify playlist just created"""
-        tracks = []
-        offset = 0
-        flag = True
-        while(flag):
-            headers = { 
-                "Authorization": "Bearer " + self.access_token,
-                "Content-Type": "application/json",
-            }
-            params = {
-                'fields': 'items(track(uri))',
-                'limit': 50,
-                'offset': len(tracks),
-            }
-            r = requests.get(end_point, headers=headers, params=params)
-            print("Response: %d tracks" % r.status_code)
-            j = r.json()
-            tracks = tracks + [item['track'] for item in j['items']]
+    def iter_playlist_tracks(self, end_point):
+        """yields the track uris of a playlist in order, None for tracks without one"""
+        # only the fields used here, plus the total the pages are planned from
+        params = {'fields': 'total,items(track(uri))'}
+        for item in self.paginate(end_point, params, label="tracks"):
+            yield item['track']['uri'] if item['track'] else None
 
-            flag = len(j['items']) > 0
+    def get_playlist_tracks(self, end_point):
+        """returns the track uris of a playlist in order, None for tracks without one"""
+        return list(self.iter_playlist_tracks(end_point))
 
-        if len(tracks) == 0:
-            return
-        
-        headers = { 
-            "Authorization": "Bearer " + self.access_token,
-            "Content-Type": "application/json",
-        }
-      
+    def clear_playlist(self, end_point, snapshot_id):
+        """removes every track from the playlist. Returns a playlist_writer.WriteResult"""
+        uris = (uri for uri in self.iter_playlist_tracks(end_point) if uri)
+        result = self.playlist_writer(end_point).remove(uris, snapshot_id)
+        if not result.ok:
+            print(result)
+        return result
+
+# ######################################## Sync songs of list ##########################################################
+    def replace_playlist(self, end_point, song_uris, snapshot_id=None):
+        """replaces every track of the playlist with song_uris: one PUT for up to 100 tracks, then one POST per
+        further 100. Returns a playlist_writer.WriteResult"""
+        result = self.playlist_writer(end_point).replace((uri for uri in song_uris if uri != None), snapshot_id)
+        print(result.added)
+        if not result.ok:
+            print(result)
+        return result
+
+    def sync_playlist(self, end_point, song_uris, snapshot_id):
+        """updates the playlist to song_uris with the fewest removals, moves and inserts, or replaces every track
+        when that takes fewer requests. Also replaces everything when the playlist holds tracks without uri
+        or an operation fails"""
+        uris = [uri for uri in song_uris if uri != None]
+        current = self.get_playlist_tracks(end_point)
+        if None in current:
+            print("Sync: playlist has tracks without uri, replacing all")
+            return self.replace_playlist(end_point, uris, snapshot_id)
+        from playlist_sync import plan_requests, plan_sync, replace_requests
+        from playlist_writer import WriteResult
 
         n = 100
-        # Iterate and slice the list
-        for i in range(0, len(tracks), n):
-            data = {
-                'tracks': tracks[i:i + n]
-            }
-            r = requests.delete(end_point, headers=headers, json=data)
-            print("Response: %d clear_playlist" % r.status_code)
+        plan = plan_sync(current, uris, n)
+        removals, moves, inserts = plan
+        cost, replace_cost = plan_requests(plan, n), replace_requests(len(uris), n)
+        print("Sync: %d removals, %d moves, %d inserts in %d requests, replacing takes %d" % (
+            len(removals), len(moves), sum(len(u) for _, u in inserts), cost, replace_cost))
+        if cost > replace_cost:
+            return self.replace_playlist(end_point, uris, snapshot_id)
+
+        requests_to_send = []
+        for i in range(0, len(removals), n):
+            tracks = {}
+            for uri, position in removals[i:i + n]:
+                tracks.setdefault(uri, []).append(position)
+            data = {'tracks': [{'uri': uri, 'positions': positions} for uri, positions in tracks.items()]}
+            requests_to_send.append(("DELETE", data))
+        for range_start, insert_before, range_length in moves:
+            requests_to_send.append(("PUT", {'range_start': range_start, 'insert_before': insert_before,
+                                             'range_length': range_length}))
+        for position, chunk in inserts:
+            requests_to_send.append(("POST", {'uris': chunk, 'position': position}))
+
+        # positional writes are applied at most once, an unknown outcome is settled by the snapshot id
+        writer = self.playlist_writer(end_point)
+        result = WriteResult(snapshot_id)
+        for i, (method, data) in enumerate(requests_to_send):
+            if method != "POST" and result.snapshot_id:
+                # positions refer to the snapshot the previous operation produced
+                data['snapshot_id'] = result.snapshot_id
+            if not writer.apply(method, data, result, i, label="sync %s" % method):
+                print("Sync: failed, replacing all")
+                return self.replace_playlist(end_point, uris)
+        return result
+
+# ######################################## Push songs to list ##########################################################
+    def push_playlist(self, end_point, song_uris, snapshot_id, sync=True):
+        """puts song_uris into the playlist behind end_point and stamps its description, creating the playlist
+        with its cover when end_point is None. With sync only what changed is written, otherwise the playlist
+        is cleared and filled again. Returns the end_point"""
+        if end_point == None:
+            with span("creating_playlist"):
+                end_point = self.creating_playlist()
+                self.add_cover(end_point)
+        if sync:
+            # only touch the tracks that changed since the last run
+            with span("sync_playlist"):
+                self.sync_playlist(end_point, song_uris, snapshot_id)
+        else:
+            with span("clear_playlist"):
+                self.clear_playlist(end_point, snapshot_id)
+            with span("adding_playlist"):
+                self.adding_playlist(end_point, song_uris)
+        with span("update_description"):
+            self.update_playlist_description(end_point)
+        return end_point
 
 # ######################################## Update description ##########################################################
     def update_playlist_description(self, end_point):
@@ -280,7 +567,7 @@ class BillboardToSpotify:
             "description": self.description,
             "public": True
         }
-        response = requests.put(playlist_endpoint, headers=headers, json=data)
+        response = self.scheduler.request("PUT", playlist_endpoint, headers=headers, json=data)
         print("Response: %d update_playlist_description" % response.status_code)
 
 # ######################################## Add cover ##########################################################
@@ -291,45 +578,94 @@ class BillboardToSpotify:
             "Authorization": "Bearer " + self.access_token,
             "Content-Type": "image/jpeg",
         }
-        with open("billboard.png", "rb") as f:
-            data = base64.b64encode(f.read())
-        response = requests.put(playlist_endpoint, headers=headers, data=data)
+        if BillboardToSpotify._cover is None:
+            with open("billboard.png", "rb") as f:
+                BillboardToSpotify._cover = base64.b64encode(f.read())
+        response = self.scheduler.request("PUT", playlist_endpoint, headers=headers, data=self._cover)
         print("Response: %d add_cover" % response.status_code)
 
-def updateBillboard(USER_ID, CLIENT_SECRET, CLIENT_ID, REDIRECT_URI):
+def updateBillboard(USER_ID, CLIENT_SECRET, CLIENT_ID, REDIRECT_URI, sync=True, force=False, report_path=None):
+    """runs one update; with report_path the stage timings, request latencies and counters are written there
+    as JSON, or as Prometheus text when it ends in .prom"""
+    try:
+        _updateBillboard(USER_ID, CLIENT_SECRET, CLIENT_ID, REDIRECT_URI, sync, force)
+    finally:
+        print(instrument.recorder.summary())
+        if report_path:
+            instrument.write_report(report_path)
+
+def _updateBillboard(USER_ID, CLIENT_SECRET, CLIENT_ID, REDIRECT_URI, sync, force):
     ## enter a date for reaching top 100 song of this date
     billboard_playlist = BillboardToSpotify(user_id=USER_ID,client_secret=CLIENT_SECRET,client_id=CLIENT_ID,redirect_uri=REDIRECT_URI)
+    updateBillboardPlaylist(billboard_playlist, sync, force)
+
+def updateBillboardPlaylist(billboard_playlist, sync=True, force=False, interactive=True):
+    """updates the playlist of billboard_playlist from its chart. Returns False when the chart is unchanged.
+    Caches and tokens already loaded into billboard_playlist are reused, so a long-running process can call it
+    again and again with the same object. Without interactive, a missing token raises instead of asking for a code"""
+    with span("fetch_chart"):
+        if force:
+            songs = billboard_playlist.billboard_top_100()
+        else:
+            songs = billboard_playlist.billboard_top_100_if_changed()
+    if songs is None:
+        print("Chart unchanged, playlist left as is")
+        return False
+    billboard_playlist.load_caches()
+    # stamped with the time of this update
+    billboard_playlist.description = None
 
     ## To reach token you should call the function of request_user_authorization. This process has two step. 1. Go to link
     #and confirm authorization. 2. Paste the code in the url code= part.As a result of this two-step process,
     # the authorization process will be completed and the token will be accessed.
-    billboard_playlist.request_user_authorization()
+    if not billboard_playlist.tokens.valid():
+        with span("authorize"):
+            billboard_playlist.request_user_authorization(interactive)
 
     # billboard_playlist.query_song_uri("Te Queria Ver artist:Aleman X Neton Vega")
     # return
-    end_point, snapshot_id = billboard_playlist.get_playlist_id()
+    with span("get_playlist"):
+        end_point, snapshot_id = billboard_playlist.get_playlist_id()
     if end_point != None:
         print("end_point: %s" % end_point)
-        billboard_playlist.clear_playlist(end_point, snapshot_id)
-        billboard_playlist.update_playlist_description(end_point)
     else:
         raise Exception("get_playlist_id failed")
-        ## create a private spotify playlist named by the entered date by calling the function creation_playlist
-        end_point = billboard_playlist.creating_playlist()
-        billboard_playlist.add_cover(end_point)
-    songs = billboard_playlist.song_uris()
+    with span("resolve"):
+        song_uris = billboard_playlist.resolve_songs(songs)
     ## add songs to playlist
-    billboard_playlist.adding_playlist(end_point, songs)
+    billboard_playlist.push_playlist(end_point, song_uris, snapshot_id, sync)
+    billboard_playlist.save_chart_state()
+    return True
+
+# the small storage keys every run reads, fetched together at startup
+STATE_FILES = ["api.json", "refresh_token.txt", "access_token.json", "chart_state.json"]
+# the caches, only fetched by load_caches once the chart changed
+CACHE_FILES = ["song_cache.json", "track_index.json", "aliases.json"]
+
+def runForSAE(run, report_path=None):
+    """returns run(), then prints the stage timings, writes them to report_path when given and uploads pending
+    storage writes before the platform freezes the process"""
+    try:
+        return run()
+    finally:
+        print(instrument.recorder.summary())
+        if report_path:
+            instrument.write_report(report_path)
+        sae_patch.flush()
 
 def updateBillboardForSAE():
-    content = json.loads(read_refresh_token("api.json"))    
+    instrument.recorder.reset()
+    with span("load_state"):
+        state = sae_patch.read_many(STATE_FILES)
+    content = json.loads(state["api.json"])    
     
     USER_ID = content['USER_ID']
     CLIENT_ID = content["CLIENT_ID"]
     CLIENT_SECRET = content["CLIENT_SECRET"]
     REDIRECT_URI= 'https://example.com'
 
-    updateBillboard(USER_ID, CLIENT_SECRET, CLIENT_ID, REDIRECT_URI)
+    runForSAE(lambda: _updateBillboard(USER_ID, CLIENT_SECRET, CLIENT_ID, REDIRECT_URI, True, False),
+              content.get("REPORT_PATH"))
 
 if __name__ == "__main__":
-    updateBillboardForSAE()
\ No newline at end of file
+    updateBillboardForSAE()
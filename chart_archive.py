@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+"""Archive of weekly Billboard charts in compact array-backed storage.
+
+Chart pages are a couple of MB of HTML each, but a week of the Hot 100 is
+only 100 (title, artist) pairs. `ChartArchive` keeps the parsed rows only:
+
+- Every distinct title and artist string is stored once in a string table,
+  every distinct (title, artist) pair once as a song, and every week as an
+  `array` of song ids in rank order, so a week costs 4 bytes per row.
+- `dumps`/`loads` serialize the archive as zlib-compressed arrays; archives
+  are saved to a local file or to OSS through an `oss_minimal.OSSClient`.
+- `weeks_for(title, artist)` lists every week a song charted, with its rank,
+  from an index built on first use.
+
+`backfill` fetches the charts of many weeks concurrently from the dated
+chart URLs (https://www.billboard.com/charts/hot-100/2024-01-06/), parses
+each page as soon as it arrives and keeps only the rows.
+
+Usage:
+    python chart_archive.py backfill 2000-01-01 2024-12-31 [--archive hot-100.bba] [--chart hot-100] [--workers 4] [--oss]
+    python chart_archive.py weeks "Blinding Lights" ["The Weeknd"] [--archive hot-100.bba] [--oss]
+    python chart_archive.py stats [--archive hot-100.bba] [--oss]
+
+Example:
+    archive = load_archive("hot-100.bba")
+    backfill(archive, chart_dates(datetime.date(2020, 1, 1), datetime.date(2020, 12, 31)))
+    save_archive(archive, "hot-100.bba")
+    for date, rank in archive.weeks_for("Blinding Lights", "The Weeknd"):
+        print("%s #%d" % (date, rank))
+"""
+
+import datetime
+import errno
+import struct
+import sys
+import zlib
+from array import array
+
+from chart_parser import format_song, parse_chart
+from cli import pop_option
+from http_session import default_session
+from song_match import normalize
+from task_pool import imap_ordered
+
+CHART_URL = "https://www.billboard.com/charts/%s/"
+MAGIC = b"BBA1"
+# charts are dated on Saturdays
+CHART_WEEKDAY = 5
+
+
+def chart_dates(start, end):
+    """Return the chart dates (Saturdays) from `start` to `end`, both datetime.date, inclusive."""
+    first = start + datetime.timedelta(days=(CHART_WEEKDAY - start.weekday()) % 7)
+    return [first + datetime.timedelta(weeks=i) for i in range((end - first).days // 7 + 1)]
+
+
+def dated_url(chart, date):
+    """Return the URL of a chart for one week, e.g. dated_url("hot-100", date)."""
+    return (CHART_URL % chart) + date.isoformat() + "/"
+
+
+def _array_bytes(values):
+    if sys.byteorder != "little":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes() if hasattr(values, "tobytes") else values.tostring()
+
+
+def _array_from(typecode, data):
+    values = array(typecode)
+    if hasattr(values, "frombytes"):
+        values.frombytes(data)
+    else:
+        values.fromstring(data)
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values
+
+
+class ChartArchive(object):
+    """Weekly chart rows stored as arrays of ids into interned strings."""
+
+    def __init__(self):
+        self.strings = []
+        self._string_ids = {}
+        # song id -> title string id and artist string id
+        self.song_titles = array("I")
+        self.song_artists = array("I")
+        self._song_ids = {}
+        # date ordinal -> array of song ids in rank order
+        self.weeks = {}
+        self._index = None
+
+    def _intern(self, text):
+        string_id = self._string_ids.get(text)
+        if string_id is None:
+            string_id = self._string_ids[text] = len(self.strings)
+            self.strings.append(text)
+        return string_id
+
+    def _song(self, title, artist):
+        key = (self._intern(title), self._intern(artist))
+        song_id = self._song_ids.get(key)
+        if song_id is None:
+            song_id = self._song_ids[key] = len(self.song_titles)
+            self.song_titles.append(key[0])
+            self.song_artists.append(key[1])
+        return song_id
+
+    def add_week(self, date, rows):
+        """Store the (title, artist) rows of the chart of `date`, replacing a stored one."""
+        self.weeks[date.toordinal()] = array("I", [self._song(u" ".join(title.split()), u" ".join(artist.split()))
+                                                   for title, artist in rows])
+        self._index = None
+
+    def __contains__(self, date):
+        return date.toordinal() in self.weeks
+
+    def __len__(self):
+        return len(self.weeks)
+
+    def dates(self):
+        """Return the archived chart dates in order."""
+        return [datetime.date.fromordinal(ordinal) for ordinal in sorted(self.weeks)]
+
+    def song(self, song_id):
+        """Return (title, artist) of a song id."""
+        return self.strings[self.song_titles[song_id]], self.strings[self.song_artists[song_id]]
+
+    def chart(self, date):
+        """Return the (title, artist) rows of the chart of `date` in rank order."""
+        return [self.song(song_id) for song_id in self.weeks[date.toordinal()]]
+
+    def songs(self, date):
+        """Return the formatted search strings of the chart of `date`, as billboard_top_100 does."""
+        return [format_song(title, artist) for title, artist in self.chart(date)]
+
+    def _build_index(self):
+        # normalized title -> song ids, and song id -> [(ordinal, rank)]
+        titles = {}
+        for song_id, title_id in enumerate(self.song_titles):
+            titles.setdefault(normalize(self.strings[title_id]), []).append(song_id)
+        weeks = {}
+        for ordinal in sorted(self.weeks):
+            for rank, song_id in enumerate(self.weeks[ordinal]):
+                weeks.setdefault(song_id, []).append((ordinal, rank + 1))
+        self._index = (titles, weeks)
+        return self._index
+
+    def weeks_for(self, title, artist=None):
+        """Return [(date, rank)] of every week a song charted, in date order.
+
+        Titles match after song_match.normalize; with `artist`, only songs whose
+        normalized artist contains it match.
+        """
+        titles, weeks = self._index or self._build_index()
+        wanted = normalize(artist) if artist else None
+        found = []
+        for song_id in titles.get(normalize(title), []):
+            if wanted and wanted not in normalize(self.strings[self.song_artists[song_id]]):
+                continue
+            found.extend(weeks.get(song_id, []))
+        return [(datetime.date.fromordinal(ordinal), rank) for ordinal, rank in sorted(found)]
+
+    def dumps(self):
+        """Return the archive as compressed bytes."""
+        ordinals = array("I", sorted(self.weeks))
+        lengths = array("I", [len(self.weeks[ordinal]) for ordinal in ordinals])
+        rows = array("I")
+        for ordinal in ordinals:
+            rows.extend(self.weeks[ordinal])
+        blocks = [
+            u"\0".join(self.strings).encode("utf-8"),
+            _array_bytes(self.song_titles),
+            _array_bytes(self.song_artists),
+            _array_bytes(ordinals),
+            _array_bytes(lengths),
+            _array_bytes(rows),
+        ]
+        body = b"".join(struct.pack("<I", len(block)) + block for block in blocks)
+        return MAGIC + zlib.compress(body, 9)
+
+    @classmethod
+    def loads(cls, data):
+        """Return the archive stored in bytes from `dumps`."""
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError("not a chart archive")
+        body = zlib.decompress(data[len(MAGIC):])
+        blocks = []
+        offset = 0
+        while offset < len(body):
+            size, = struct.unpack("<I", body[offset:offset + 4])
+            blocks.append(body[offset + 4:offset + 4 + size])
+            offset += 4 + size
+        strings, titles, artists, ordinals, lengths, rows = blocks
+        archive = cls()
+        archive.strings = strings.decode("utf-8").split(u"\0") if titles else []
+        archive._string_ids = dict((text, i) for i, text in enumerate(archive.strings))
+        archive.song_titles = _array_from("I", titles)
+        archive.song_artists = _array_from("I", artists)
+        archive._song_ids = dict(((t, a), i) for i, (t, a) in enumerate(zip(archive.song_titles, archive.song_artists)))
+        rows = _array_from("I", rows)
+        start = 0
+        for ordinal, length in zip(_array_from("I", ordinals), _array_from("I", lengths)):
+            archive.weeks[ordinal] = rows[start:start + length]
+            start += length
+        return archive
+
+    def stats(self):
+        """Return counts and the in-memory size of the row and song arrays in bytes."""
+        row_count = sum(len(rows) for rows in self.weeks.values())
+        return {
+            "weeks": len(self.weeks),
+            "rows": row_count,
+            "songs": len(self.song_titles),
+            "strings": len(self.strings),
+            "array_bytes": (row_count + 2 * len(self.song_titles)) * self.song_titles.itemsize,
+        }
+
+
+def save_archive(archive, path, client=None):
+    """Save an archive to a local file, or to the OSS key `path` with an OSSClient."""
+    data = archive.dumps()
+    if client is not None:
+        client.put_object(path, data)
+        return
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def load_archive(path, client=None):
+    """Load an archive from a local file or OSS key; a missing one gives an empty archive.
+
+    Any other failure is raised, so a backfill never saves over an archive it could not read.
+    """
+    try:
+        if client is not None:
+            data = client.get_object(path)
+        else:
+            with open(path, "rb") as f:
+                data = f.read()
+    except Exception as e:
+        # a missing file, or OSS NoSuchKey
+        status = getattr(getattr(e, "response", None), "status_code", None)
+        if status != 404 and getattr(e, "errno", None) != errno.ENOENT:
+            raise
+        print("Archive: %s not found, starting empty (%s)" % (path, e))
+        return ChartArchive()
+    return ChartArchive.loads(data)
+
+
+def backfill(archive, dates, chart="hot-100", session=None, workers=4, parser="stream"):
+    """Fetch and archive the charts of `dates` not archived yet, `workers` at a time.
+
+    Returns the dates that could not be fetched or parsed.
+    """
+    session = session or default_session()
+    missing = [date for date in dates if date not in archive]
+
+    def fetch(date):
+        try:
+            respond = session.get(dated_url(chart, date), timeout=30)
+            respond.raise_for_status()
+            rows = parse_chart(respond.text, parser)
+        except Exception as e:
+            print("Archive: %s failed (%s)" % (date, e))
+            return date, None
+        print("Response: %d billboard %s, %d rows" % (respond.status_code, date, len(rows)))
+        return date, rows
+
+    failed = []
+    for date, rows in imap_ordered(fetch, missing, concurrency=workers):
+        if rows:
+            archive.add_week(date, rows)
+        else:
+            failed.append(date)
+    return failed
+
+
+def _parse_date(text):
+    return datetime.datetime.strptime(text, "%Y-%m-%d").date()
+
+
+def main(argv):
+    argv = list(argv)
+    chart = pop_option(argv, "--chart", "hot-100")
+    path = pop_option(argv, "--archive", chart + ".bba")
+    workers = int(pop_option(argv, "--workers", "4"))
+    client = None
+    if "--oss" in argv:
+        argv.remove("--oss")
+        import sae_patch
+        client = sae_patch._oss_client()
+    if not argv:
+        raise SystemExit(__doc__)
+    archive = load_archive(path, client)
+
+    if argv[0] == "backfill":
+        dates = chart_dates(_parse_date(argv[1]), _parse_date(argv[2]))
+        # save once a year of weeks, so an interrupted backfill keeps its progress
+        for i in range(0, len(dates), 52):
+            failed = backfill(archive, dates[i:i + 52], chart, workers=workers)
+            save_archive(archive, path, client)
+            if failed:
+                print("Archive: %d weeks failed: %s" % (len(failed), ", ".join(str(date) for date in failed)))
+        argv = ["stats"]
+    if argv[0] == "weeks":
+        for date, rank in archive.weeks_for(argv[1], argv[2] if len(argv) > 2 else None):
+            print("%s #%d" % (date, rank))
+    elif argv[0] == "stats":
+        stats = archive.stats()
+        print("%(weeks)d weeks, %(rows)d rows, %(songs)d songs, %(strings)d strings, %(array_bytes)d bytes of arrays"
+              % stats)
+        print("%d bytes compressed" % len(archive.dumps()))
+
+
+__all__ = ["ChartArchive", "backfill", "chart_dates", "dated_url", "load_archive", "save_archive"]
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
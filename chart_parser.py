@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""Parsers for Billboard chart pages.
+
+Every backend returns the chart rows as (title, artist) tuples holding the raw
+text of the row's `h3#title-of-a-story` and of the `span` following it, and
+`format_song` turns a row into the search string used across the project.
+
+- "soup": builds a BeautifulSoup tree of the whole page, as
+  `billboard_top_100` originally did.
+- "strainer": BeautifulSoup with a SoupStrainer, so only the
+  `o-chart-results-list-row-container` rows become tree nodes.
+- "stream" (default): an HTMLParser tokenizer that starts at the first row,
+  keeps no tree, and stops after the last row. It does not need bs4.
+
+`bench_chart_parser.py` compares the backends on saved chart pages.
+
+Example:
+    songs = [format_song(title, artist) for title, artist in parse_chart(html)]
+"""
+
+try:
+    from html.parser import HTMLParser
+    from html.entities import name2codepoint
+except ImportError:
+    from HTMLParser import HTMLParser
+    from htmlentitydefs import name2codepoint
+
+try:
+    unichr
+except NameError:
+    unichr = chr
+
+ROW_CLASS = "o-chart-results-list-row-container"
+TITLE_ID = "title-of-a-story"
+
+VOID_TAGS = frozenset([
+    "area", "base", "br", "col", "embed", "hr", "img", "input",
+    "link", "meta", "param", "source", "track", "wbr",
+])
+
+
+def format_song(title, artist):
+    """Return the search string for a chart row."""
+    song = title + "  artist:" + artist
+    return (song
+            .replace('\t', '')
+            .replace('\n', '')
+            .replace('Featuring', ' ')
+            .replace('  ', ' '))
+
+
+def parse_soup(html):
+    """Parse with a full BeautifulSoup tree."""
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, "html.parser")
+    rows = soup.find_all("div", class_=ROW_CLASS)
+    titles = [row.find("h3", id=TITLE_ID) for row in rows]
+    return [(title.getText(), title.find_next_sibling("span").getText()) for title in titles]
+
+
+def parse_strainer(html):
+    """Parse with BeautifulSoup, building nodes only for the chart rows."""
+    from bs4 import BeautifulSoup, SoupStrainer
+
+    only_rows = SoupStrainer("div", attrs={"class": ROW_CLASS})
+    soup = BeautifulSoup(html, "html.parser", parse_only=only_rows)
+    rows = soup.find_all("div", class_=ROW_CLASS)
+    titles = [row.find("h3", id=TITLE_ID) for row in rows]
+    return [(title.getText(), title.find_next_sibling("span").getText()) for title in titles]
+
+
+class _RowParser(HTMLParser):
+    """Collects (title, artist) from chart rows while tokenizing."""
+
+    def __init__(self, expected_rows):
+        HTMLParser.__init__(self)
+        self.rows = []
+        self.remaining = expected_rows
+        self.done = False
+        self.stack = []
+        self.row_depth = None
+        self.title_depth = None
+        self.sibling_depth = None
+        self.artist_depth = None
+        self.title = None
+        self.text = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag in VOID_TAGS:
+            return
+        self.stack.append(tag)
+        depth = len(self.stack)
+        if self.row_depth is None:
+            if tag == "div":
+                classes = dict(attrs).get("class") or ""
+                if ROW_CLASS in classes.split():
+                    self.row_depth = depth
+                    self.title = None
+            return
+        if self.title is None and self.title_depth is None:
+            if tag == "h3" and dict(attrs).get("id") == TITLE_ID:
+                self.title_depth = depth
+                self.text = []
+        elif self.sibling_depth == depth and tag == "span":
+            self.sibling_depth = None
+            self.artist_depth = depth
+            self.text = []
+
+    def handle_endtag(self, tag):
+        # like the tree builders, an end tag closes every element opened after
+        # its start tag and stray end tags are ignored
+        if tag in VOID_TAGS or tag not in self.stack:
+            return
+        while True:
+            depth = len(self.stack)
+            name = self.stack.pop()
+            if self.row_depth is not None:
+                self._close(depth)
+            if name == tag:
+                return
+
+    def _close(self, depth):
+        if depth == self.title_depth:
+            self.title = u"".join(self.text)
+            self.title_depth = None
+            self.sibling_depth = depth
+            self.text = None
+        elif depth == self.artist_depth:
+            self.rows.append((self.title, u"".join(self.text)))
+            self.artist_depth = None
+            self.text = None
+        elif self.sibling_depth is not None and depth < self.sibling_depth:
+            # the title had no following span
+            self.sibling_depth = None
+        if depth == self.row_depth:
+            self.row_depth = None
+            self.title_depth = self.artist_depth = self.sibling_depth = None
+            self.text = None
+            self.remaining -= 1
+            self.done = self.remaining <= 0
+
+    def handle_data(self, data):
+        if self.text is not None:
+            self.text.append(data)
+
+    def handle_entityref(self, name):
+        if self.text is not None:
+            self.text.append(unichr(name2codepoint[name]) if name in name2codepoint else u"&%s;" % name)
+
+    def handle_charref(self, name):
+        if self.text is not None:
+            if name[:1] in ("x", "X"):
+                self.text.append(unichr(int(name[1:], 16)))
+            else:
+                self.text.append(unichr(int(name)))
+
+
+def parse_stream(html, chunk_size=64 * 1024):
+    """Parse by tokenizing only the part of the page holding the rows."""
+    first = html.find(ROW_CLASS)
+    if first < 0:
+        return []
+    start = html.rfind("<", 0, first)
+    parser = _RowParser(html.count(ROW_CLASS))
+    for offset in range(start, len(html), chunk_size):
+        parser.feed(html[offset:offset + chunk_size])
+        if parser.done:
+            break
+    return parser.rows
+
+
+BACKENDS = {
+    "soup": parse_soup,
+    "strainer": parse_strainer,
+    "stream": parse_stream,
+}
+
+
+def parse_chart(html, backend="stream"):
+    """Return the chart rows of a page as (title, artist) tuples."""
+    return BACKENDS[backend](html)
+
+
+__all__ = ["format_song", "parse_chart", "parse_soup", "parse_strainer", "parse_stream", "BACKENDS"]
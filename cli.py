@@ -0,0 +1,19 @@
+"""Command-line helpers shared by the scripts of this project.
+
+Example:
+    argv = list(sys.argv[1:])
+    interval = int(pop_option(argv, "--interval", "3600"))
+"""
+
+
+def pop_option(argv, name, default):
+    """Remove `name` and the value after it from `argv` and return the value, `default` when absent."""
+    if name in argv:
+        i = argv.index(name)
+        value = argv[i + 1]
+        del argv[i:i + 2]
+        return value
+    return default
+
+
+__all__ = ["pop_option"]
@@ -0,0 +1,67 @@
+"""Shared connection-pooled HTTP session for Spotify, Billboard and OSS calls.
+
+A `requests.Session` keeps TCP+TLS connections alive between requests, so a
+full run reuses a few connections per host instead of opening one per call.
+
+- `pool_maxsize` connections are kept per host, sized for the search workers
+  in `BillboardToSpotify.song_uris`.
+- With `pool_block` set, callers wait for a free connection instead of opening
+  extra throwaway ones, which caps the connections per host.
+- `host_limits` overrides the per-host cap for individual hosts.
+- `requests` is imported when the first session is created, so importing
+  this module costs nothing at startup.
+
+Example:
+    from http_session import default_session, new_session
+
+    session = new_session(pool_maxsize=4, host_limits={"www.billboard.com": 1})
+    session.get("https://www.billboard.com/charts/hot-100/")
+"""
+
+import threading
+
+_lock = threading.Lock()
+_default = None
+
+
+def new_session(pool_connections=8, pool_maxsize=10, pool_block=True, host_limits=None):
+    """Return a new pooled session.
+
+    pool_connections is the number of hosts to keep pools for, pool_maxsize
+    the number of connections kept per host.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        pool_block=pool_block,
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    for host, limit in (host_limits or {}).items():
+        host_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=limit, pool_block=pool_block)
+        session.mount("https://%s/" % host, host_adapter)
+        session.mount("http://%s/" % host, host_adapter)
+    return session
+
+
+def default_session():
+    """Return the process-wide session, creating it on first use."""
+    global _default
+    with _lock:
+        if _default is None:
+            _default = new_session()
+        return _default
+
+
+def set_default_session(session):
+    """Replace the process-wide session, e.g. with one from `new_session`."""
+    global _default
+    with _lock:
+        _default = session
+
+
+__all__ = ["new_session", "default_session", "set_default_session"]
@@ -0,0 +1,198 @@
+"""Instrumentation of an update run: stage spans, request latencies, counters.
+
+One process-wide `recorder` collects:
+
+- spans: wall time of the pipeline stages (chart fetch, authorization,
+  resolution, playlist writes, ...), recorded with `with span("resolve"):`.
+- requests: per endpoint latency histograms, status codes and bytes sent and
+  received, recorded by the request scheduler, the OSS client and the chart
+  fetch through `observe`.
+- counters: retries, 429 responses, cache and storage hits and misses,
+  recorded through `incr`.
+
+At the end of a run `write_report(path)` writes everything as JSON, or in the
+Prometheus text format when the path ends in ".prom".
+
+Example:
+    with span("resolve"):
+        uris = resolve(songs)
+    observe("GET /v1/search", 0.12, status=200, bytes_received=5120)
+    incr("cache_lookups", cache="song_cache.json", result="hit")
+    write_report("report.json")
+"""
+
+import json
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_ID_SEGMENT = re.compile(r"^[0-9A-Za-z]{16,}$")
+
+
+def endpoint_name(method, url):
+    """Return "METHOD host/path" with IDs and user names replaced by {id}."""
+    # imported here to keep startup cheap; Python 2 first, since trying urllib.parse
+    # there imports the old urllib, and ssl with it
+    try:
+        from urlparse import urlparse
+    except ImportError:
+        from urllib.parse import urlparse
+
+    parsed = urlparse(url)
+    segments = parsed.path.split("/")
+    for i, segment in enumerate(segments):
+        if _ID_SEGMENT.match(segment) or (i > 0 and segments[i - 1] in ("users", "playlists", "charts")):
+            segments[i] = "{id}"
+    return "%s %s%s" % (method, parsed.netloc, "/".join(segments))
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+class Recorder(object):
+    """Thread-safe collector of spans, request observations and counters."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.spans = []
+            self.requests = {}
+            self.counters = {}
+
+    @contextmanager
+    def span(self, name):
+        begin = time.time()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.spans.append((name, begin - self.started, time.time() - begin))
+
+    def observe(self, endpoint, seconds, status=None, bytes_sent=0, bytes_received=0):
+        with self._lock:
+            stats = self.requests.get(endpoint)
+            if stats is None:
+                stats = self.requests[endpoint] = {
+                    "count": 0,
+                    "seconds": 0.0,
+                    "buckets": [0] * len(BUCKETS),
+                    "statuses": {},
+                    "bytes_sent": 0,
+                    "bytes_received": 0,
+                }
+            stats["count"] += 1
+            stats["seconds"] += seconds
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    stats["buckets"][i] += 1
+            status = str(status)
+            stats["statuses"][status] = stats["statuses"].get(status, 0) + 1
+            stats["bytes_sent"] += bytes_sent
+            stats["bytes_received"] += bytes_received
+
+    def incr(self, name, value=1, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def report(self):
+        """Return everything recorded as a JSON-serializable dict."""
+        with self._lock:
+            counters = {}
+            caches = {}
+            for (name, labels), value in sorted(self.counters.items()):
+                label_text = ",".join("%s=%s" % item for item in labels)
+                counters[name + ("{%s}" % label_text if label_text else "")] = value
+                labels = dict(labels)
+                if name == "cache_lookups":
+                    cache = caches.setdefault(labels.get("cache"), {"hit": 0, "miss": 0})
+                    cache[labels.get("result")] = cache.get(labels.get("result"), 0) + value
+            for cache in caches.values():
+                total = cache["hit"] + cache["miss"]
+                cache["hit_rate"] = float(cache["hit"]) / total if total else None
+            requests = {}
+            for endpoint, stats in self.requests.items():
+                requests[endpoint] = dict(stats, buckets=dict(zip([str(b) for b in BUCKETS], stats["buckets"])),
+                                          mean_seconds=stats["seconds"] / stats["count"])
+            return {
+                "started": self.started,
+                "seconds": time.time() - self.started,
+                "spans": [{"name": name, "offset": offset, "seconds": seconds}
+                          for name, offset, seconds in self.spans],
+                "requests": requests,
+                "counters": counters,
+                "caches": caches,
+            }
+
+    def prometheus(self):
+        """Return everything recorded in the Prometheus text format."""
+        def label_text(labels):
+            return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in labels)
+
+        lines = []
+        with self._lock:
+            stages = {}
+            for name, _, seconds in self.spans:
+                stages[name] = stages.get(name, 0.0) + seconds
+            lines.append("# TYPE billboard_stage_seconds gauge")
+            for name, seconds in sorted(stages.items()):
+                lines.append("billboard_stage_seconds%s %f" % (label_text([("stage", name)]), seconds))
+
+            lines.append("# TYPE billboard_request_seconds histogram")
+            for endpoint, stats in sorted(self.requests.items()):
+                for bound, count in zip(BUCKETS, stats["buckets"]):
+                    lines.append("billboard_request_seconds_bucket%s %d" % (
+                        label_text([("endpoint", endpoint), ("le", bound)]), count))
+                lines.append("billboard_request_seconds_bucket%s %d" % (
+                    label_text([("endpoint", endpoint), ("le", "+Inf")]), stats["count"]))
+                lines.append("billboard_request_seconds_sum%s %f" % (label_text([("endpoint", endpoint)]), stats["seconds"]))
+                lines.append("billboard_request_seconds_count%s %d" % (label_text([("endpoint", endpoint)]), stats["count"]))
+            lines.append("# TYPE billboard_requests_total counter")
+            for endpoint, stats in sorted(self.requests.items()):
+                for status, count in sorted(stats["statuses"].items()):
+                    lines.append("billboard_requests_total%s %d" % (
+                        label_text([("endpoint", endpoint), ("status", status)]), count))
+            lines.append("# TYPE billboard_request_bytes_total counter")
+            for endpoint, stats in sorted(self.requests.items()):
+                for direction in ("sent", "received"):
+                    lines.append("billboard_request_bytes_total%s %d" % (
+                        label_text([("endpoint", endpoint), ("direction", direction)]), stats["bytes_" + direction]))
+
+            names = sorted(set(name for name, _ in self.counters))
+            for name in names:
+                lines.append("# TYPE billboard_%s_total counter" % name)
+                for (counter, labels), value in sorted(self.counters.items()):
+                    if counter == name:
+                        lines.append("billboard_%s_total%s %d" % (name, label_text(labels) if labels else "", value))
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """Return a one-line summary of the stage timings."""
+        with self._lock:
+            stages = ", ".join("%s %.2fs" % (name, seconds) for name, _, seconds in self.spans)
+            count = sum(stats["count"] for stats in self.requests.values())
+        return "Timing: %.2fs total, %d requests; %s" % (time.time() - self.started, count, stages)
+
+    def write_report(self, path):
+        """Write the report to `path`, as Prometheus text for ".prom" files, JSON otherwise."""
+        content = self.prometheus() if path.endswith(".prom") else json.dumps(self.report(), indent=2, sort_keys=True)
+        with open(path, "w") as f:
+            f.write(content)
+
+
+recorder = Recorder()
+span = recorder.span
+observe = recorder.observe
+incr = recorder.incr
+write_report = recorder.write_report
+
+
+__all__ = ["Recorder", "recorder", "span", "observe", "incr", "write_report", "endpoint_name"]
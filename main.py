@@ -0,0 +1,58 @@
+"""Entry point for one update run, e.g. one serverless invocation.
+
+Usage:
+    python main.py [--force] [--charts] [--accounts]
+    python main.py --service [--interval 3600] [--port 8765]
+    USER_ID=xxx CLIENT_ID=xxx CLIENT_SECRET=xxx python main.py [--force]
+
+Without USER_ID in the environment the credentials come from api.json in
+storage, as in updateBillboardForSAE; --charts runs the batch runner for
+every chart in charts.json instead, --accounts pushes the chart to every
+account in accounts.json, and --service keeps running as
+`service.UpdateService`. Nothing but `os` and `sys` is imported
+before the run starts, and the run itself imports what it needs when it
+needs it, so an invocation that finds the chart unchanged only loads the
+chart check, the storage and the HTTP session.
+`profile_imports.py` measures what each module costs to import.
+"""
+
+import os
+import sys
+
+
+def main(argv):
+    if "--service" in argv:
+        import service
+
+        return service.main([arg for arg in argv if arg != "--service"])
+    if "--charts" in argv:
+        from batch_runner import updateChartsForSAE
+
+        return updateChartsForSAE()
+    if "--accounts" in argv:
+        from accounts import updateAccountsForSAE
+
+        return updateAccountsForSAE()
+    if not os.environ.get("USER_ID"):
+        from billboard_to_spotify import updateBillboardForSAE
+
+        return updateBillboardForSAE()
+
+    import sae_patch
+    from billboard_to_spotify import updateBillboard
+
+    try:
+        updateBillboard(
+            os.environ["USER_ID"],
+            os.environ["CLIENT_SECRET"],
+            os.environ["CLIENT_ID"],
+            os.environ.get("REDIRECT_URI", "https://example.com"),
+            force="--force" in argv,
+            report_path=os.environ.get("REPORT_PATH"),
+        )
+    finally:
+        sae_patch.flush()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,368 @@
+"""Local stand-in for the Spotify, Billboard and OSS endpoints.
+
+`MockServices` runs a threaded HTTP server on 127.0.0.1 that answers the
+calls made by `BillboardToSpotify` and `oss_minimal`, so whole runs can be
+driven offline and measured reproducibly:
+
+- accounts.spotify.com: token refresh and authorization.
+- api.spotify.com: search, track lookups, user playlists, playlist tracks
+  (paged reads, inserts, removals by uri or position, reorders), playlist
+  details and cover images.
+- www.billboard.com: the chart page passed in, with an ETag so conditional
+  requests get a 304.
+- every other host: an OSS bucket kept in memory, with conditional and
+  ranged GETs and multipart upload.
+
+`session()` returns a `RedirectSession`, which sends every https:// request
+to the mock server and keeps the original host as the first path segment.
+Install it with `http_session.set_default_session` to redirect everything
+that uses the shared session.
+
+Latency is added to every response; 5xx and 429 responses are injected into
+the Spotify Web API calls with the given rates. Every request is counted per
+route, and injected faults are counted separately.
+
+Example:
+    services = MockServices(chart_html, latency=0.05, rate_limit_rate=0.02).start()
+    http_session.set_default_session(services.session())
+    href, snapshot_id = services.add_playlist("user", "Billboard Hot 100", [])
+    ...
+    print(services.counts)
+    services.stop()
+"""
+
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+
+API_HOST = "api.spotify.com"
+ACCOUNTS_HOST = "accounts.spotify.com"
+BILLBOARD_HOST = "www.billboard.com"
+
+_PLAYLIST_PATH = re.compile(r"^/v1/playlists/([^/]+)(/tracks|/images)?$")
+_USER_PLAYLISTS_PATH = re.compile(r"^/v1/users/([^/]+)/playlists$")
+
+
+def track_uri(query):
+    """Return the track uri the mock search finds for a query."""
+    return "spotify:track:" + hashlib.sha1(query.encode("utf-8")).hexdigest()[:22]
+
+
+def _query(text):
+    """Return the parsed query string with text values; parse_qs of Python 2 leaves them UTF-8 bytes."""
+    return dict((name, [value if isinstance(value, type(u"")) else value.decode("utf-8") for value in values])
+                for name, values in parse_qs(text, keep_blank_values=True).items())
+
+
+def _route(host, path):
+    """Return "host/path" with playlist and user IDs replaced by {id}, for counting."""
+    path = _PLAYLIST_PATH.sub(lambda m: "/v1/playlists/{id}" + (m.group(2) or ""), path)
+    path = _USER_PLAYLISTS_PATH.sub("/v1/users/{id}/playlists", path)
+    if host not in (API_HOST, ACCOUNTS_HOST, BILLBOARD_HOST):
+        return "oss"
+    return host + path
+
+
+class RedirectSession(requests.Session):
+    """Session that sends https:// requests to `base_url`/<host>/<path> instead."""
+
+    def __init__(self, base_url, pool_maxsize=10):
+        requests.Session.__init__(self)
+        self.base_url = base_url
+        self.mount("http://", HTTPAdapter(pool_connections=8, pool_maxsize=pool_maxsize, pool_block=True))
+
+    def request(self, method, url, *args, **kwargs):
+        parsed = urlparse(url)
+        if parsed.scheme == "https":
+            url = "%s/%s%s" % (self.base_url, parsed.netloc, parsed.path)
+            if parsed.query:
+                url += "?" + parsed.query
+        return requests.Session.request(self, method, url, *args, **kwargs)
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _dispatch(self):
+        services = self.server.services
+        host, _, rest = self.path.lstrip("/").partition("/")
+        parsed = urlparse("/" + rest)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        status, headers, content = services.handle(self.command, host, parsed.path, _query(parsed.query),
+                                                    dict((k.lower(), v) for k, v in self.headers.items()), body)
+        if isinstance(content, dict) or isinstance(content, list):
+            content = json.dumps(content).encode("utf-8")
+            headers.setdefault("Content-Type", "application/json")
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if "Content-Length" not in headers:
+            self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        if self.command != "HEAD" and status != 304:
+            self.wfile.write(content)
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = _dispatch
+
+
+class MockServices(object):
+    """In-memory Spotify, Billboard and OSS behind one local HTTP server."""
+
+    def __init__(self, chart_html=u"", latency=0.0, error_rate=0.0, rate_limit_rate=0.0, retry_after=1,
+                 not_found_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.not_found_rate = not_found_rate
+        self.set_chart(chart_html)
+        # playlist id -> {"name", "owner", "uris", "snapshot"}
+        self.playlists = {}
+        self.objects = {}
+        self.uploads = {}
+        self.counts = {}
+        self.faults = {"429": 0, "503": 0}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    def set_chart(self, chart_html):
+        """Serve a new chart page, with a new ETag."""
+        self.chart = chart_html.encode("utf-8")
+        self.chart_etag = '"%s"' % hashlib.md5(self.chart).hexdigest()
+
+    def start(self):
+        self._server = _Server(("127.0.0.1", 0), _Handler)
+        self._server.services = self
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % self._server.server_address[1]
+
+    def session(self, pool_maxsize=10):
+        """Return a session that sends every https:// request to this server."""
+        return RedirectSession(self.url, pool_maxsize)
+
+    def reset_counts(self):
+        with self._lock:
+            self.counts = {}
+            self.faults = {"429": 0, "503": 0}
+
+    def add_playlist(self, user_id, name, uris):
+        """Create a playlist. Returns its tracks href and snapshot id."""
+        with self._lock:
+            playlist_id = hashlib.sha1(("%s/%s" % (user_id, name)).encode("utf-8")).hexdigest()[:22]
+            self.playlists[playlist_id] = {"name": name, "owner": user_id, "uris": list(uris), "snapshot": 1}
+            return self._playlist_json(playlist_id)["tracks"]["href"], "1"
+
+    def playlist_uris(self, href):
+        """Return the track uris of the playlist behind a tracks href."""
+        with self._lock:
+            return list(self.playlists[href.split("/")[-2]]["uris"])
+
+    # ###################################### request handling ##################################################
+    def handle(self, method, host, path, query, headers, body):
+        """Return (status, headers, content) for one request."""
+        time.sleep(self.latency)
+        with self._lock:
+            route = "%s %s" % (method, _route(host, path))
+            self.counts[route] = self.counts.get(route, 0) + 1
+            if host == API_HOST:
+                draw = self._random.random()
+                if draw < self.rate_limit_rate:
+                    self.faults["429"] += 1
+                    return 429, {"Retry-After": str(self.retry_after)}, {"error": {"status": 429}}
+                if draw < self.rate_limit_rate + self.error_rate:
+                    self.faults["503"] += 1
+                    return 503, {}, {"error": {"status": 503}}
+                # cover uploads are base64 JPEG, every other body is JSON
+                is_json = body and not path.endswith("/images")
+                return self._spotify(method, path, query, json.loads(body.decode("utf-8")) if is_json else {})
+            if host == ACCOUNTS_HOST:
+                if path == "/api/token":
+                    return 200, {}, {"access_token": "mock-access-token", "token_type": "Bearer", "expires_in": 3600}
+                return 200, {}, b"authorize"
+            if host == BILLBOARD_HOST:
+                if headers.get("if-none-match") == self.chart_etag:
+                    return 304, {"ETag": self.chart_etag, "Content-Length": "0"}, b""
+                return 200, {"ETag": self.chart_etag, "Content-Type": "text/html; charset=utf-8"}, self.chart
+            return self._oss(method, host + path, query, headers, body)
+
+    def _playlist_json(self, playlist_id):
+        playlist = self.playlists[playlist_id]
+        href = "https://%s/v1/playlists/%s" % (API_HOST, playlist_id)
+        return {
+            "id": playlist_id,
+            "name": playlist["name"],
+            "owner": {"id": playlist["owner"]},
+            "snapshot_id": str(playlist["snapshot"]),
+            "tracks": {"href": href + "/tracks", "total": len(playlist["uris"])},
+        }
+
+    def _page(self, items, query, default_limit, href):
+        offset = int(query.get("offset", ["0"])[0])
+        limit = int(query.get("limit", [str(default_limit)])[0])
+        page = items[offset:offset + limit]
+        more = offset + limit < len(items)
+        return {
+            "href": href,
+            "items": page,
+            "limit": limit,
+            "offset": offset,
+            "total": len(items),
+            "next": "%s?offset=%d&limit=%d" % (href, offset + limit, limit) if more else None,
+            "previous": None,
+        }
+
+    def _changed(self, playlist):
+        playlist["snapshot"] += 1
+        return 200, {}, {"snapshot_id": str(playlist["snapshot"])}
+
+    def _spotify(self, method, path, query, data):
+        if path == "/v1/search":
+            q = query["q"][0]
+            if "artist:" in q and (int(hashlib.md5(q.encode("utf-8")).hexdigest()[:8], 16) % 1000
+                                   < self.not_found_rate * 1000):
+                items = []
+            else:
+                title, _, artist = q.partition(" artist:")
+                items = [{"uri": track_uri(q), "name": title, "artists": [{"name": artist or "Unknown"}]}]
+            return 200, {}, {"tracks": {"items": items, "total": len(items)}}
+        if path == "/v1/tracks":
+            ids = query["ids"][0].split(",")
+            return 200, {}, {"tracks": [{"uri": "spotify:track:" + i, "is_playable": True} for i in ids]}
+
+        match = _USER_PLAYLISTS_PATH.match(path)
+        if match:
+            user_id = match.group(1)
+            if method == "POST":
+                playlist_id = hashlib.sha1(("%s/%s" % (user_id, data["name"])).encode("utf-8")).hexdigest()[:22]
+                self.playlists[playlist_id] = {"name": data["name"], "owner": user_id, "uris": [], "snapshot": 1}
+                return 201, {}, self._playlist_json(playlist_id)
+            items = [self._playlist_json(i) for i in sorted(self.playlists)]
+            return 200, {}, self._page(items, query, 20, "https://%s%s" % (API_HOST, path))
+
+        match = _PLAYLIST_PATH.match(path)
+        if not match or match.group(1) not in self.playlists:
+            return 404, {}, {"error": {"status": 404, "message": "Not found."}}
+        playlist = self.playlists[match.group(1)]
+        uris = playlist["uris"]
+        if match.group(2) == "/images":
+            return 202, {}, b""
+        if match.group(2) is None:
+            if method == "PUT":
+                playlist["name"] = data.get("name", playlist["name"])
+                return 200, {}, b""
+            return 200, {}, self._playlist_json(match.group(1))
+
+        if method == "GET":
+            items = [{"track": {"uri": uri}} for uri in uris]
+            return 200, {}, self._page(items, query, 100, "https://%s%s" % (API_HOST, path))
+        if (method == "DELETE" and data.get("snapshot_id", str(playlist["snapshot"])) != str(playlist["snapshot"])
+                and any("positions" in track for track in data.get("tracks", []))):
+            # positions only make sense against the snapshot they were computed for
+            return 400, {}, {"error": {"status": 400, "message": "Invalid snapshot"}}
+        if method == "POST":
+            new = data.get("uris", [])
+            if len(new) > 100:
+                return 400, {}, {"error": {"status": 400, "message": "Too many ids requested"}}
+            position = data.get("position", len(uris))
+            uris[position:position] = new
+            return self._changed(playlist)
+        if method == "DELETE":
+            tracks = data.get("tracks", [])
+            if len(tracks) > 100:
+                return 400, {}, {"error": {"status": 400, "message": "Too many tracks"}}
+            drop = set()
+            for track in tracks:
+                if "positions" in track:
+                    drop.update(p for p in track["positions"] if uris[p] == track["uri"])
+                else:
+                    drop.update(i for i, uri in enumerate(uris) if uri == track["uri"])
+            playlist["uris"] = [uri for i, uri in enumerate(uris) if i not in drop]
+            return self._changed(playlist)
+        if method == "PUT":
+            if "uris" in data:
+                if len(data["uris"]) > 100:
+                    return 400, {}, {"error": {"status": 400, "message": "Too many ids requested"}}
+                playlist["uris"] = list(data["uris"])
+                return self._changed(playlist)
+            start, before, length = data["range_start"], data["insert_before"], data.get("range_length", 1)
+            moved = uris[start:start + length]
+            rest = uris[:start] + uris[start + length:]
+            if before > start:
+                before -= length
+            playlist["uris"] = rest[:before] + moved + rest[before:]
+            return self._changed(playlist)
+        return 405, {}, b""
+
+    def _oss(self, method, key, query, headers, body):
+        if method == "POST" and "uploads" in query:
+            upload_id = "upload%d" % len(self.uploads)
+            self.uploads[upload_id] = {}
+            return 200, {"Content-Type": "application/xml"}, (
+                "<InitiateMultipartUploadResult><UploadId>%s</UploadId></InitiateMultipartUploadResult>"
+                % upload_id).encode("utf-8")
+        if "uploadId" in query:
+            upload_id = query["uploadId"][0]
+            if method == "PUT":
+                self.uploads[upload_id][int(query["partNumber"][0])] = body
+                return 200, {"ETag": '"%s"' % hashlib.md5(body).hexdigest()}, b""
+            parts = self.uploads.pop(upload_id)
+            if method == "POST":
+                self.objects[key] = b"".join(parts[n] for n in sorted(parts))
+            return 200, {}, b""
+        if method == "PUT":
+            self.objects[key] = body
+            return 200, {"ETag": '"%s"' % hashlib.md5(body).hexdigest()}, b""
+        if method == "DELETE":
+            self.objects.pop(key, None)
+            return 204, {}, b""
+        if key not in self.objects:
+            return 404, {"Content-Type": "application/xml"}, b"<Error><Code>NoSuchKey</Code></Error>"
+        data = self.objects[key]
+        etag = '"%s"' % hashlib.md5(data).hexdigest()
+        if method == "HEAD":
+            return 200, {"ETag": etag, "Content-Length": str(len(data))}, b""
+        if headers.get("if-none-match") == etag:
+            return 304, {"ETag": etag, "Content-Length": "0"}, b""
+        if "range" in headers:
+            start, end = [int(n) for n in headers["range"][len("bytes="):].split("-")]
+            return 206, {"ETag": etag}, data[start:end + 1]
+        return 200, {"ETag": etag}, data
+
+
+__all__ = ["MockServices", "RedirectSession", "track_uri"]
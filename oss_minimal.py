@@ -3,6 +3,13 @@
 The helpers sign requests with Signature V2:
 - Only standard libraries and `requests` are required.
 - Supports simple GET and PUT against a bucket endpoint.
+- Requests go through the pooled session from `http_session` unless a
+  `session` is passed in.
+- `put_object_stream`/`get_object_stream` move large objects with constant
+  memory, using multipart upload and ranged GETs in parallel.
+- `OSSClient` keeps the credentials, a pre-keyed HMAC and a per-second date
+  string, so signing a request costs one HMAC copy. The module functions use
+  one cached client per bucket and credentials.
 
 Example:
     from oss_minimal import get_object, put_object
@@ -22,14 +29,21 @@ Example:
         access_key_secret="SECRET",
         endpoint="oss-cn-hangzhou.aliyuncs.com",
     )
+
+    client = OSSClient("my-bucket", "AKID", "SECRET", "oss-cn-hangzhou.aliyuncs.com")
+    client.put_object("path/to/file.txt", b"hello")
 """
 
 import base64
 import datetime as _dt
 import hashlib
 import hmac
+import threading
+import time
 
-import requests
+import instrument
+from http_session import default_session
+from task_pool import map_ordered
 
 
 def _rfc1123_now():
@@ -82,6 +96,220 @@ def _object_url(bucket, endpoint, key):
     return "https://%s.%s/%s" % (bucket, endpoint, key.lstrip("/"))
 
 
+def _xml_text(content, tag):
+    """Return the text of the first element named `tag`, ignoring namespaces."""
+    from xml.etree import ElementTree
+
+    for element in ElementTree.fromstring(content).iter():
+        if element.tag == tag or element.tag.endswith("}" + tag):
+            return element.text
+    return None
+
+
+class OSSClient(object):
+    """Signed requests against one bucket with precomputed signing state."""
+
+    def __init__(self, bucket, access_key_id, access_key_secret, endpoint, session=None, timeout=15):
+        self.bucket = bucket
+        self.endpoint = endpoint
+        self.access_key_id = access_key_id
+        self.session = session
+        self.timeout = timeout
+        self._hmac = hmac.new(access_key_secret.encode("utf-8"), digestmod=hashlib.sha1)
+        self._auth_prefix = "OSS %s:" % access_key_id
+        self._resource_prefix = "/%s/" % bucket
+        self._url_prefix = "https://%s.%s/" % (bucket, endpoint)
+        self._date = (None, None)
+
+    def _now(self):
+        """Return the RFC 1123 date, formatted once per second."""
+        second = int(time.time())
+        cached_second, date = self._date
+        if cached_second != second:
+            date = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(second))
+            self._date = (second, date)
+        return date
+
+    def sign(self, method, content_md5, content_type, date, canonicalized_headers, canonicalized_resource):
+        """Return Authorization header value for OSS V2."""
+        parts = [method, content_md5 or "", content_type or "", date]
+        if canonicalized_headers:
+            parts.append(canonicalized_headers)
+        parts.append(canonicalized_resource)
+        mac = self._hmac.copy()
+        mac.update("\n".join(parts).encode("utf-8"))
+        return self._auth_prefix + base64.b64encode(mac.digest()).decode("utf-8")
+
+    def signed_headers(self, method, key, subresource="", content_md5="", content_type="", extra_headers=None):
+        """Return the request headers including Date and Authorization."""
+        date = self._now()
+        headers = {"Date": date}
+        if content_md5:
+            headers["Content-MD5"] = content_md5
+        if content_type:
+            headers["Content-Type"] = content_type
+        canonicalized = ""
+        if extra_headers:
+            headers.update(extra_headers)
+            canonicalized = _canonicalized_headers(headers)
+        resource = self._resource_prefix + key.lstrip("/")
+        if subresource:
+            resource += "?" + subresource
+        headers["Authorization"] = self.sign(method, content_md5, content_type, date, canonicalized, resource)
+        return headers
+
+    def request(self, method, key, subresource="", data=None, content_md5="", content_type="",
+                extra_headers=None, timeout=None):
+        """Send a signed request; `subresource` is the query string, e.g. "uploads".
+
+        Raises requests.HTTPError on non-2xx responses.
+        """
+        headers = self.signed_headers(method, key, subresource, content_md5, content_type, extra_headers)
+        url = self._url_prefix + key.lstrip("/")
+        if subresource:
+            url += "?" + subresource
+        begin = time.time()
+        resp = (self.session or default_session()).request(
+            method,
+            url,
+            data=data,
+            headers=headers,
+            timeout=timeout or self.timeout,
+        )
+        instrument.observe("OSS " + method, time.time() - begin, resp.status_code,
+                           bytes_sent=len(data or ""), bytes_received=len(resp.content or ""))
+        resp.raise_for_status()
+        return resp
+
+    def put_object(self, key, data, content_type="application/octet-stream", extra_headers=None, timeout=None):
+        """Upload bytes via PUT and return the new ETag.
+
+        Raises requests.HTTPError on non-2xx responses.
+        """
+        md5_b64 = base64.b64encode(hashlib.md5(data).digest()).decode("utf-8")
+        resp = self.request("PUT", key, data=data, content_md5=md5_b64, content_type=content_type,
+                            extra_headers=extra_headers, timeout=timeout)
+        return resp.headers.get("ETag")
+
+    def get_object(self, key, extra_headers=None, timeout=None):
+        """Download object bytes via GET. Raises requests.HTTPError on non-2xx responses."""
+        return self.request("GET", key, extra_headers=extra_headers, timeout=timeout).content
+
+    def get_object_if_changed(self, key, etag=None, timeout=None):
+        """Download object bytes unless the object still has `etag`.
+
+        Returns (content, etag), with content None when the object is unchanged.
+        Raises requests.HTTPError on other non-2xx responses.
+        """
+        extra_headers = {"If-None-Match": etag} if etag else None
+        resp = self.request("GET", key, extra_headers=extra_headers, timeout=timeout)
+        if resp.status_code == 304:
+            return None, etag
+        return resp.content, resp.headers.get("ETag")
+
+    def put_object_stream(self, key, fileobj, content_type="application/octet-stream",
+                          part_size=8 * 1024 * 1024, workers=4, timeout=60):
+        """Upload a file-like object with constant memory.
+
+        Objects smaller than `part_size` go through `put_object`. Larger ones use
+        multipart upload: parts are read one after another while up to `workers`
+        of them upload in parallel, each with its own Content-MD5, so at most
+        `workers` parts are held in memory. A failed upload is aborted.
+
+        Returns the hex MD5 and the size of everything read from `fileobj`.
+        Raises requests.HTTPError on non-2xx responses.
+        """
+        md5 = hashlib.md5()
+        first = fileobj.read(part_size)
+        md5.update(first)
+        if len(first) < part_size:
+            self.put_object(key, first, content_type=content_type, timeout=timeout)
+            return md5.hexdigest(), len(first)
+
+        resp = self.request("POST", key, subresource="uploads", content_type=content_type, timeout=timeout)
+        upload_id = _xml_text(resp.content, "UploadId")
+        state = {"size": len(first)}
+
+        def parts():
+            number, data = 1, first
+            while data:
+                yield number, data
+                data = fileobj.read(part_size)
+                md5.update(data)
+                state["size"] += len(data)
+                number += 1
+
+        def upload(part):
+            number, data = part
+            part_md5 = base64.b64encode(hashlib.md5(data).digest()).decode("utf-8")
+            resp = self.request("PUT", key, subresource="partNumber=%d&uploadId=%s" % (number, upload_id),
+                                data=data, content_md5=part_md5, timeout=timeout)
+            return number, resp.headers["ETag"]
+
+        try:
+            etags = map_ordered(upload, parts(), concurrency=workers)
+            body = "<CompleteMultipartUpload>%s</CompleteMultipartUpload>" % "".join(
+                "<Part><PartNumber>%d</PartNumber><ETag>%s</ETag></Part>" % (number, etag)
+                for number, etag in etags
+            )
+            self.request("POST", key, subresource="uploadId=%s" % upload_id, data=body.encode("utf-8"),
+                         content_type="application/xml", timeout=timeout)
+        except Exception:
+            try:
+                self.request("DELETE", key, subresource="uploadId=%s" % upload_id, timeout=timeout)
+            except Exception as e:
+                print("OSS: cannot abort upload %s (%s)" % (upload_id, e))
+            raise
+        return md5.hexdigest(), state["size"]
+
+    def get_object_stream(self, key, target, range_size=8 * 1024 * 1024, workers=4, timeout=60):
+        """Download an object with parallel ranged GETs.
+
+        `target` is a file object opened for binary writing, or a writable buffer
+        (bytearray, memoryview) at least as large as the object. Each range is
+        written at its offset as soon as it arrives, so at most `workers` ranges
+        are held in memory.
+
+        Returns the object size. Raises requests.HTTPError on non-2xx responses.
+        """
+        resp = self.request("HEAD", key, timeout=timeout)
+        size = int(resp.headers["Content-Length"])
+        is_file = hasattr(target, "seek")
+        if not is_file and len(target) < size:
+            raise ValueError("buffer of %d bytes is too small for %d bytes" % (len(target), size))
+        lock = threading.Lock()
+
+        def fetch(start):
+            end = min(start + range_size, size) - 1
+            resp = self.request("GET", key, extra_headers={"Range": "bytes=%d-%d" % (start, end)}, timeout=timeout)
+            data = resp.content
+            if len(data) != end - start + 1:
+                raise IOError("range %d-%d returned %d bytes" % (start, end, len(data)))
+            if is_file:
+                with lock:
+                    target.seek(start)
+                    target.write(data)
+            else:
+                target[start:end + 1] = data
+
+        map_ordered(fetch, range(0, size, range_size), concurrency=workers)
+        return size
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _client(bucket, access_key_id, access_key_secret, endpoint, session=None):
+    """Return the cached client for a bucket, credentials and session."""
+    key = (bucket, endpoint, access_key_id, access_key_secret, session)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = OSSClient(bucket, access_key_id, access_key_secret, endpoint, session)
+        return client
+
+
 def put_object(
     bucket,
     key,
@@ -92,39 +320,14 @@ def put_object(
     content_type="application/octet-stream",
     extra_headers=None,
     timeout=15,
+    session=None,
 ):
     """Upload bytes to OSS via PUT.
 
     Raises requests.HTTPError on non-2xx responses.
     """
-    md5_b64 = base64.b64encode(hashlib.md5(data).digest()).decode("utf-8")
-    date = _rfc1123_now()
-    headers = {
-        "Content-MD5": md5_b64,
-        "Content-Type": content_type,
-        "Date": date,
-    }
-    if extra_headers:
-        headers.update(extra_headers)
-    canonicalized = _canonicalized_headers(headers)
-    resource = "/%s/%s" % (bucket, key.lstrip("/"))
-    headers["Authorization"] = _sign(
-        method="PUT",
-        content_md5=md5_b64,
-        content_type=content_type,
-        date=date,
-        canonicalized_headers=canonicalized,
-        canonicalized_resource=resource,
-        access_key_id=access_key_id,
-        access_key_secret=access_key_secret,
-    )
-    resp = requests.put(
-        _object_url(bucket, endpoint, key),
-        data=data,
-        headers=headers,
-        timeout=timeout,
-    )
-    resp.raise_for_status()
+    _client(bucket, access_key_id, access_key_secret, endpoint, session).put_object(
+        key, data, content_type=content_type, extra_headers=extra_headers, timeout=timeout)
 
 
 def get_object(
@@ -135,34 +338,49 @@ def get_object(
     endpoint,
     extra_headers=None,
     timeout=15,
+    session=None,
 ):
     """Download object bytes via GET.
 
     Raises requests.HTTPError on non-2xx responses.
     """
-    date = _rfc1123_now()
-    headers = {"Date": date}
-    if extra_headers:
-        headers.update(extra_headers)
-    canonicalized = _canonicalized_headers(headers)
-    resource = "/%s/%s" % (bucket, key.lstrip("/"))
-    headers["Authorization"] = _sign(
-        method="GET",
-        content_md5="",
-        content_type="",
-        date=date,
-        canonicalized_headers=canonicalized,
-        canonicalized_resource=resource,
-        access_key_id=access_key_id,
-        access_key_secret=access_key_secret,
-    )
-    resp = requests.get(
-        _object_url(bucket, endpoint, key),
-        headers=headers,
-        timeout=timeout,
-    )
-    resp.raise_for_status()
-    return resp.content
+    return _client(bucket, access_key_id, access_key_secret, endpoint, session).get_object(
+        key, extra_headers=extra_headers, timeout=timeout)
+
+
+def put_object_stream(
+    bucket,
+    key,
+    fileobj,
+    access_key_id,
+    access_key_secret,
+    endpoint,
+    content_type="application/octet-stream",
+    part_size=8 * 1024 * 1024,
+    workers=4,
+    timeout=60,
+    session=None,
+):
+    """Upload a file-like object with constant memory, see OSSClient.put_object_stream."""
+    return _client(bucket, access_key_id, access_key_secret, endpoint, session).put_object_stream(
+        key, fileobj, content_type=content_type, part_size=part_size, workers=workers, timeout=timeout)
+
+
+def get_object_stream(
+    bucket,
+    key,
+    target,
+    access_key_id,
+    access_key_secret,
+    endpoint,
+    range_size=8 * 1024 * 1024,
+    workers=4,
+    timeout=60,
+    session=None,
+):
+    """Download an object into a file or buffer, see OSSClient.get_object_stream."""
+    return _client(bucket, access_key_id, access_key_secret, endpoint, session).get_object_stream(
+        key, target, range_size=range_size, workers=workers, timeout=timeout)
 
 
-__all__ = ["put_object", "get_object"]
\ No newline at end of file
+__all__ = ["OSSClient", "put_object", "get_object", "put_object_stream", "get_object_stream"]
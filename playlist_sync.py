@@ -0,0 +1,128 @@
+"""Minimal edit plan that turns one playlist track list into another.
+
+`plan_sync(current, target)` compares the track URIs a playlist holds today
+with the URIs it should hold and returns the operations the Spotify playlist
+endpoints need, instead of clearing the playlist and adding everything back:
+
+- removals: (uri, position) pairs for tracks not in the target, highest
+  position first, so removing them in chunks never shifts a pending position.
+- moves: (range_start, insert_before, range_length) triples for the reorder
+  endpoint. Tracks on the longest run that is already in target order stay
+  put, and tracks that sit next to each other in target order are moved
+  together as one range.
+- inserts: (position, uris) pairs for new tracks, at most `chunk` URIs each,
+  in ascending position order.
+
+Each operation is applied to the result of the previous one. Repeated URIs are
+told apart by their occurrence number.
+
+`plan_requests` counts the requests a plan costs and `replace_requests` what
+replacing every track costs, so a caller can pick the cheaper of the two.
+
+Example:
+    removals, moves, inserts = plan_sync(["a", "b", "c"], ["c", "a", "d"])
+    # removals == [("b", 1)], moves == [(0, 2, 1)], inserts == [(2, ["d"])]
+"""
+
+import bisect
+
+
+def _occurrence_keys(uris):
+    seen = {}
+    keys = []
+    for uri in uris:
+        seen[uri] = seen.get(uri, 0) + 1
+        keys.append((uri, seen[uri]))
+    return keys
+
+
+def _longest_increasing(values):
+    """Return the set of indexes of one longest increasing subsequence."""
+    tails = []
+    tail_index = []
+    previous = [None] * len(values)
+    for i, value in enumerate(values):
+        k = bisect.bisect_left(tails, value)
+        if k == len(tails):
+            tails.append(value)
+            tail_index.append(i)
+        else:
+            tails[k] = value
+            tail_index[k] = i
+        previous[i] = tail_index[k - 1] if k > 0 else None
+    keep = set()
+    i = tail_index[-1] if tail_index else None
+    while i is not None:
+        keep.add(i)
+        i = previous[i]
+    return keep
+
+
+def plan_sync(current, target, chunk=100):
+    """Return (removals, moves, inserts) turning `current` into `target`."""
+    current_keys = _occurrence_keys(current)
+    target_keys = _occurrence_keys(target)
+    target_set = set(target_keys)
+
+    removals = [(key[0], pos) for pos, key in enumerate(current_keys) if key not in target_set]
+    removals.reverse()
+
+    kept = [key for key in current_keys if key in target_set]
+    kept_set = set(kept)
+    ordered = [key for key in target_keys if key in kept_set]
+    rank = dict((key, i) for i, key in enumerate(ordered))
+    stay = set(kept[i] for i in _longest_increasing([rank[key] for key in kept]))
+
+    # Move every other track right behind its predecessor in the target order;
+    # tracks placed so far plus the staying ones are then always in order.
+    # Followers that already sit right behind it in the layout go along in the same range.
+    moves = []
+    layout = list(kept)
+    i = 0
+    while i < len(ordered):
+        key = ordered[i]
+        if key in stay:
+            i += 1
+            continue
+        start = layout.index(key)
+        insert_before = layout.index(ordered[i - 1]) + 1 if i > 0 else 0
+        length = 1
+        while (i + length < len(ordered) and ordered[i + length] not in stay
+               and start + length < len(layout) and layout[start + length] == ordered[i + length]):
+            length += 1
+        if insert_before != start:
+            moves.append((start, insert_before, length))
+            block = layout[start:start + length]
+            del layout[start:start + length]
+            position = insert_before - length if start < insert_before else insert_before
+            layout[position:position] = block
+        i += length
+
+    inserts = []
+    run_start = None
+    for pos, key in enumerate(target_keys + [None]):
+        if key is not None and key not in kept_set:
+            if run_start is None:
+                run_start = pos
+            continue
+        if run_start is not None:
+            for offset in range(run_start, pos, chunk):
+                inserts.append((offset, [k[0] for k in target_keys[offset:min(pos, offset + chunk)]]))
+            run_start = None
+
+    return removals, moves, inserts
+
+
+def plan_requests(plan, chunk=100):
+    """Return the number of requests a plan from plan_sync costs: removals go `chunk` per DELETE."""
+    removals, moves, inserts = plan
+    return -(-len(removals) // chunk) + len(moves) + len(inserts)
+
+
+def replace_requests(count, chunk=100):
+    """Return the number of requests replacing every track with `count` tracks costs:
+    one PUT for the first `chunk`, one POST for each further `chunk`."""
+    return max(1, -(-count // chunk))
+
+
+__all__ = ["plan_requests", "plan_sync", "replace_requests"]
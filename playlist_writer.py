@@ -0,0 +1,198 @@
+"""Bulk writes of playlist tracks within the Spotify API limits.
+
+`PlaylistWriter` turns adding or removing any number of tracks into requests
+of at most `chunk` (100) tracks each:
+
+- `add` inserts chunks one after another at consecutive positions, so the
+  tracks end up in the given order.
+- `apply` sends one write that must not happen twice, like a positional
+  insert, move or removal; `add` uses it for every chunk. A write whose
+  outcome is unknown (a 5xx or a connection error) is not resent blindly:
+  the playlist's snapshot id is fetched, and a snapshot that moved on since
+  the last known one means the write was applied.
+- `replace` sets the whole track list: one PUT with the first chunk, which
+  gives the same result when repeated, then `add` for the rest.
+- `remove` deletes chunks by uri. Removing every occurrence of a uri gives
+  the same result in any order and when repeated, so the chunks are sent
+  `workers` at a time and failed ones are simply retried.
+- All three take any iterable of uris and consume it as they go, so tracks
+  can be streamed in from a generator without a list of them all.
+- They return a `WriteResult` with the counts, the snapshot id of the last
+  change, the number of requests and the chunks that failed, instead of
+  only printing errors.
+
+The writer assumes nobody else edits the playlist during a write.
+
+Example:
+    writer = PlaylistWriter(scheduler, tracks_href, lambda: access_token)
+    result = writer.add(uris, position=0)
+    if not result.ok:
+        print(result.errors)
+"""
+
+import random
+import threading
+import time
+from itertools import islice
+
+from task_pool import map_ordered
+
+
+class WriteResult(object):
+    """Outcome of a bulk playlist write."""
+
+    def __init__(self, snapshot_id=None):
+        self.snapshot_id = snapshot_id
+        self.added = 0
+        # distinct uris removed
+        self.removed = 0
+        self.requests = 0
+        # (method, first track index of the chunk, status code or error text)
+        self.errors = []
+
+    @property
+    def ok(self):
+        return not self.errors
+
+    def __repr__(self):
+        return "WriteResult(added=%d, removed=%d, requests=%d, errors=%d, snapshot_id=%r)" % (
+            self.added, self.removed, self.requests, len(self.errors), self.snapshot_id)
+
+
+class PlaylistWriter(object):
+    """Chunked, retried track inserts and removals for one playlist."""
+
+    def __init__(self, scheduler, end_point, access_token, chunk=100, workers=4, retries=3, backoff=0.5):
+        self.scheduler = scheduler
+        # the playlist's tracks href, https://api.spotify.com/v1/playlists/{id}/tracks
+        self.end_point = end_point
+        self.access_token = access_token
+        self.chunk = chunk
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self._lock = threading.Lock()
+
+    def _headers(self):
+        return {
+            "Authorization": "Bearer " + self.access_token(),
+            "Content-Type": "application/json",
+        }
+
+    def _send(self, method, url, result, **kwargs):
+        """Send one request, returning (response, error text)."""
+        import requests
+
+        with self._lock:
+            result.requests += 1
+        try:
+            return self.scheduler.request(method, url, headers=self._headers(), **kwargs), None
+        except requests.RequestException as e:
+            return None, str(e)
+
+    def snapshot(self, result):
+        """Return the playlist's current snapshot id, None when it cannot be read."""
+        r, _ = self._send("GET", self.end_point.replace("/tracks", ""), result, params={"fields": "snapshot_id"})
+        if r is None or r.status_code != 200:
+            return None
+        return r.json().get("snapshot_id")
+
+    def add(self, uris, position=None, snapshot_id=None):
+        """Insert `uris` in order at `position`, or append them when it is None."""
+        result = WriteResult(snapshot_id)
+        uris = iter(uris)
+        start = 0
+        while True:
+            body = {"uris": list(islice(uris, self.chunk))}
+            if not body["uris"]:
+                break
+            if position is not None:
+                body["position"] = position + start
+            if not self.apply("POST", body, result, start):
+                break
+            result.added += len(body["uris"])
+            start += len(body["uris"])
+        return result
+
+    def replace(self, uris, snapshot_id=None):
+        """Replace every track of the playlist with `uris`, in order."""
+        uris = iter(uris)
+        first = list(islice(uris, self.chunk))
+        result = WriteResult(snapshot_id)
+        r, error = self._send("PUT", self.end_point, result, json={"uris": first})
+        print("Response: %s replace_playlist" % (r.status_code if r is not None else error))
+        if r is None or r.status_code >= 300:
+            result.errors.append(("PUT", 0, r.status_code if r is not None else error))
+            return result
+        result.added = len(first)
+        result.snapshot_id = r.json().get("snapshot_id", snapshot_id)
+        rest = self.add(uris, position=len(first), snapshot_id=result.snapshot_id)
+        result.added += rest.added
+        result.requests += rest.requests
+        result.errors.extend((method, start + len(first), error) for method, start, error in rest.errors)
+        result.snapshot_id = rest.snapshot_id
+        return result
+
+    def apply(self, method, body, result, start=0, label="adding_playlist"):
+        """Send one write at most once, retrying only while it was not applied.
+
+        Returns True once it was applied and moves result.snapshot_id on;
+        otherwise the failure is added to result.errors under `start`.
+        """
+        if result.snapshot_id is None:
+            result.snapshot_id = self.snapshot(result)
+        before = result.snapshot_id
+        for attempt in range(self.retries + 1):
+            r, error = self._send(method, self.end_point, result, json=body, retry_errors=False)
+            print("Response: %s %s" % (r.status_code if r is not None else error, label))
+            if r is not None and r.status_code < 300:
+                result.snapshot_id = r.json().get("snapshot_id", before)
+                return True
+            if r is not None and r.status_code < 500 and r.status_code != 429:
+                # rejected, repeating it cannot help
+                print(r.text)
+                result.errors.append((method, start, r.status_code))
+                return False
+            current = self.snapshot(result)
+            if before is not None and current is not None and current != before:
+                print("%s at %d was applied, not resending" % (method, start))
+                result.snapshot_id = current
+                return True
+            if attempt < self.retries:
+                time.sleep(random.uniform(0, self.backoff * (2 ** attempt)))
+        result.errors.append((method, start, r.status_code if r is not None else error))
+        return False
+
+    def remove(self, uris, snapshot_id=None):
+        """Remove every occurrence of `uris` from the playlist, chunks in parallel."""
+        result = WriteResult(snapshot_id)
+        unique = []
+        seen = set()
+        for uri in uris:
+            if uri not in seen:
+                seen.add(uri)
+                unique.append(uri)
+
+        def delete(start):
+            chunk = unique[start:start + self.chunk]
+            body = {"tracks": [{"uri": uri} for uri in chunk]}
+            for attempt in range(self.retries + 1):
+                r, error = self._send("DELETE", self.end_point, result, json=body)
+                print("Response: %s clear_playlist" % (r.status_code if r is not None else error))
+                if r is not None and r.status_code < 300:
+                    with self._lock:
+                        result.removed += len(chunk)
+                        result.snapshot_id = r.json().get("snapshot_id", result.snapshot_id)
+                    return
+                if r is not None and r.status_code < 500 and r.status_code != 429:
+                    break
+                if attempt < self.retries:
+                    time.sleep(random.uniform(0, self.backoff * (2 ** attempt)))
+            with self._lock:
+                result.errors.append(("DELETE", start, r.status_code if r is not None else error))
+
+        map_ordered(delete, range(0, len(unique), self.chunk), concurrency=self.workers)
+        return result
+
+
+__all__ = ["PlaylistWriter", "WriteResult"]
@@ -0,0 +1,72 @@
+"""Measure the import time of the project's modules in fresh interpreters.
+
+Usage:
+    python profile_imports.py [module ...] [--repeat N]
+
+Every module is imported in a new interpreter `--repeat` times (default 5)
+and the fastest time is printed, together with the heavy third-party and
+standard library modules the import pulled in. Without modules the entry
+point and the modules of a run are profiled. On Python 3.7+ run
+`python -X importtime main.py` for a per-module breakdown.
+"""
+
+import os
+import subprocess
+import sys
+
+MODULES = [
+    "main",
+    "billboard_to_spotify",
+    "batch_runner",
+    "sae_patch",
+    "oss_minimal",
+    "http_session",
+    "rate_limit",
+    "chart_parser",
+    "song_cache",
+    "song_match",
+    "playlist_writer",
+    "requests",
+    "bs4",
+]
+# loaded by a full run, but not needed to find an unchanged chart
+HEAVY = ["requests", "bs4", "difflib", "xml.etree.ElementTree", "tempfile", "song_match", "playlist_writer"]
+
+PROBE = """
+import sys, time
+begin = time.time()
+import %s
+elapsed = time.time() - begin
+print("%%f %%s" %% (elapsed, ",".join(m for m in %r if m in sys.modules)))
+"""
+
+
+def profile(module, repeat):
+    """Return (best seconds, heavy modules loaded) for importing `module`."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    best, loaded = None, ""
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, "-c", PROBE % (module, HEAVY)], cwd=here)
+        seconds, _, loaded = output.decode("utf-8").strip().partition(" ")
+        best = float(seconds) if best is None else min(best, float(seconds))
+    return best, loaded
+
+
+def main(argv):
+    repeat = 5
+    if "--repeat" in argv:
+        i = argv.index("--repeat")
+        repeat = int(argv[i + 1])
+        argv = argv[:i] + argv[i + 2:]
+    print("Python %s" % sys.version.split()[0])
+    for module in argv or MODULES:
+        try:
+            seconds, loaded = profile(module, repeat)
+        except subprocess.CalledProcessError:
+            print("  %-22s cannot be imported" % module)
+            continue
+        print("  %-22s %7.1f ms  %s" % (module, seconds * 1000, loaded))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,196 @@
+"""Rate-limit-aware request scheduler for the Spotify Web API.
+
+Every Spotify call made by `BillboardToSpotify` goes through one shared
+`RequestScheduler`, which keeps the request rate near the API ceiling without
+retry storms:
+
+- A token bucket spaces requests out to `rate` per second, allowing bursts of
+  up to `burst` requests. The rate adapts: every successful response raises
+  it by `rate_step`, up to `max_rate`, so a run without 429s climbs toward
+  the API ceiling instead of staying at the starting rate.
+- A 429 response pauses all callers for the `Retry-After` seconds the API
+  asks for and halves both the rate, down to `min_rate`, and the number of
+  requests allowed in flight. Successful responses raise the number in
+  flight again, one step at a time, up to `max_concurrency`.
+- Connection errors, timeouts and 5xx responses of GET, PUT and DELETE are
+  retried with exponential backoff and full jitter. A POST that failed that
+  way may still have been applied, so its error is returned unless the
+  caller opts in with `retry_errors=True`; writes that must not be repeated
+  blindly, like positional moves, pass `retry_errors=False`.
+- Every attempt is recorded in `instrument`, as are retries and 429s.
+
+Example:
+    from rate_limit import RequestScheduler
+
+    scheduler = RequestScheduler(session, rate=10)
+    response = scheduler.request("GET", "https://api.spotify.com/v1/search", params=params, headers=headers)
+"""
+
+import random
+import threading
+import time
+
+import instrument
+from http_session import default_session
+
+RETRY_STATUS = (500, 502, 503, 504)
+# methods whose errors are retried unless the caller says otherwise
+IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "PUT", "DELETE", "OPTIONS"])
+
+
+def _retry_after(response, default=1.0):
+    """Return the Retry-After header of a response in seconds."""
+    try:
+        return max(float(response.headers.get("Retry-After", default)), 0.0)
+    except ValueError:
+        return default
+
+
+class RequestScheduler(object):
+    """Thread-safe token bucket with 429 handling, backoff, adaptive rate and adaptive concurrency."""
+
+    def __init__(
+        self,
+        session=None,
+        rate=10.0,
+        burst=20,
+        max_rate=100.0,
+        min_rate=1.0,
+        rate_step=1.0,
+        max_concurrency=10,
+        min_concurrency=1,
+        retries=4,
+        rate_limit_retries=10,
+        backoff=0.5,
+        max_backoff=30.0,
+        timeout=15,
+    ):
+        self.session = session or default_session()
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.max_rate = max(float(max_rate), self.rate)
+        self.min_rate = min(float(min_rate), self.rate)
+        self.rate_step = float(rate_step)
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.retries = retries
+        self.rate_limit_retries = rate_limit_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+
+        self.concurrency = max_concurrency
+        self._in_flight = 0
+        self._successes = 0
+        self._tokens = self.burst
+        self._refilled_at = time.time()
+        self._paused_until = 0.0
+        self._cond = threading.Condition()
+        self._bucket_lock = threading.Lock()
+
+    def _acquire_slot(self):
+        with self._cond:
+            while self._in_flight >= self.concurrency:
+                self._cond.wait(0.2)
+            self._in_flight += 1
+
+    def _release_slot(self):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def _take_token(self):
+        """Block until the bucket holds a token and the 429 pause is over."""
+        while True:
+            with self._bucket_lock:
+                now = time.time()
+                wait = self._paused_until - now
+                if wait <= 0:
+                    self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+                    self._refilled_at = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def _on_rate_limited(self, retry_after):
+        with self._bucket_lock:
+            self._paused_until = max(self._paused_until, time.time() + retry_after)
+            self._tokens = 0
+            self.rate = max(self.min_rate, self.rate / 2)
+        with self._cond:
+            self.concurrency = max(self.min_concurrency, self.concurrency // 2)
+            self._successes = 0
+
+    def _on_success(self):
+        with self._bucket_lock:
+            self.rate = min(self.max_rate, self.rate + self.rate_step)
+        with self._cond:
+            self._successes += 1
+            if self._successes >= self.concurrency and self.concurrency < self.max_concurrency:
+                self.concurrency += 1
+                self._successes = 0
+                self._cond.notify_all()
+
+    def _sleep_backoff(self, attempt):
+        time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * (2 ** attempt))))
+
+    def request(self, method, url, retry_errors=None, **kwargs):
+        """Send a request, retrying 429s, 5xx and connection errors.
+
+        Returns the final response; other 4xx responses are returned as is.
+        Raises the last requests.RequestException once retries run out.
+        With `retry_errors` False only 429s are retried, since a request the
+        API rate limited was not applied. It defaults to True for
+        IDEMPOTENT_METHODS and False for POST.
+        """
+        import requests
+
+        if retry_errors is None:
+            retry_errors = method.upper() in IDEMPOTENT_METHODS
+        retries = self.retries if retry_errors else 0
+        kwargs.setdefault("timeout", self.timeout)
+        endpoint = instrument.endpoint_name(method, url)
+        attempt = 0
+        limited = 0
+        while True:
+            self._acquire_slot()
+            try:
+                self._take_token()
+                begin = time.time()
+                response = self.session.request(method, url, **kwargs)
+                body = getattr(getattr(response, "request", None), "body", None)
+                instrument.observe(endpoint, time.time() - begin, response.status_code,
+                                   bytes_sent=len(body or ""), bytes_received=len(response.content or ""))
+            except requests.RequestException as e:
+                instrument.observe(endpoint, time.time() - begin, "error")
+                if attempt >= retries:
+                    raise
+                print("Retry: %s %s (%s)" % (method, url, e))
+                response = None
+            finally:
+                self._release_slot()
+
+            if response is not None and response.status_code == 429:
+                if limited >= self.rate_limit_retries:
+                    return response
+                limited += 1
+                instrument.incr("rate_limited", endpoint=endpoint)
+                retry_after = _retry_after(response)
+                print("Response: 429 %s, waiting %.1fs" % (url, retry_after))
+                self._on_rate_limited(retry_after)
+                continue
+            if response is not None and response.status_code not in RETRY_STATUS:
+                self._on_success()
+                return response
+            if response is not None:
+                if attempt >= retries:
+                    return response
+                print("Response: %d %s, retrying" % (response.status_code, url))
+            instrument.incr("retries", endpoint=endpoint)
+            self._sleep_backoff(attempt)
+            attempt += 1
+
+
+__all__ = ["IDEMPOTENT_METHODS", "RequestScheduler"]
@@ -1,9 +1,51 @@
-"""Switchable refresh_token.txt storage between local file and OSS."""
+"""Switchable refresh_token.txt storage between local file and OSS.
+
+In OSS mode reads and writes go through `TieredStore`, which keeps an
+in-process copy and an on-disk copy of every object in front of OSS:
+
+- A read is served from memory when this process wrote the value or checked
+  it within the last `max_age` seconds. Otherwise the object is fetched with
+  If-None-Match, so an unchanged object costs a 304 without a body, and a
+  fresh process starts from the copy on disk.
+- Writes land in memory at once and are uploaded together `flush_delay`
+  seconds later, so bursts of writes to the same key cost one PUT. `flush()`
+  uploads pending writes immediately and runs at exit. Failed uploads are
+  retried with backoff; if any still fails, `flush()` raises StorageError
+  and the writes stay pending, so a run never ends as if they were saved.
+- `read_many`/`write_many` read or write several keys concurrently over the
+  shared connection pool, so loading all state at startup costs one round
+  trip instead of one per key.
+- The disk copy lives in a directory only this user can open, and keys
+  holding credentials (`SECRET_PREFIXES`) are never written to disk.
+"""
 
 import __builtin__
+import atexit
 import os
+import random
+import threading
+import time
+
+import instrument
+from oss_minimal import OSSClient
+from task_pool import map_ordered
+
+
+# keys holding credentials, kept in memory and OSS only, never in the disk cache
+SECRET_PREFIXES = ("api.json", "accounts.json", "refresh_token", "access_token")
+
 
-from oss_minimal import get_object, put_object
+def is_missing(error):
+    """Return True when a storage error means the key does not exist (OSS NoSuchKey, a 404)."""
+    return getattr(getattr(error, "response", None), "status_code", None) == 404
+
+
+class StorageError(IOError):
+    """Raised by flush when pending writes could not be uploaded."""
+
+    def __init__(self, keys):
+        IOError.__init__(self, "cannot upload %s" % ", ".join(keys))
+        self.keys = keys
 
 
 def _storage_mode():
@@ -36,6 +78,202 @@ def _write_local(filename, data):
         f.write(data)
 
 
+_client = None
+_client_lock = threading.Lock()
+
+
+def _oss_client():
+    """Return the OSS client for the configured bucket, created once."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            bucket, endpoint, access_key_id, access_key_secret = _oss_config()
+            _client = OSSClient(bucket, access_key_id, access_key_secret, endpoint)
+        return _client
+
+
+class TieredStore(object):
+    """Memory and disk cache in front of OSS with coalesced writes."""
+
+    def __init__(self, client_factory=_oss_client, cache_dir=None, max_age=60, flush_delay=1.0, workers=8,
+                 retries=3, backoff=0.5):
+        self._client_factory = client_factory
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self._cache_dir = cache_dir
+        self.max_age = max_age
+        self.flush_delay = flush_delay
+        # key -> [data, etag, checked_at, dirty]
+        self._entries = {}
+        self._lock = threading.RLock()
+        self._timer = None
+        # None until the cache directory was checked, then whether it is private
+        self._disk_ok = None
+
+    @property
+    def cache_dir(self):
+        """The disk cache directory, by default billboard_storage in the temp directory."""
+        if self._cache_dir is None:
+            import tempfile
+
+            self._cache_dir = os.path.join(tempfile.gettempdir(), "billboard_storage")
+        return self._cache_dir
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key.replace("/", "%2F"))
+
+    def _private_dir(self):
+        """Create the cache directory with mode 0700; False when it is not owned by this user."""
+        if self._disk_ok is None:
+            try:
+                if not os.path.isdir(self.cache_dir):
+                    os.makedirs(self.cache_dir, 0o700)
+                st = os.lstat(self.cache_dir)
+                self._disk_ok = not hasattr(os, "getuid") or st.st_uid == os.getuid()
+                if self._disk_ok and st.st_mode & 0o077:
+                    # made by an earlier version with default permissions, which also cached credentials
+                    os.chmod(self.cache_dir, 0o700)
+                    for name in os.listdir(self.cache_dir):
+                        if name.startswith(SECRET_PREFIXES):
+                            os.remove(os.path.join(self.cache_dir, name))
+            except (IOError, OSError) as e:
+                print("Storage: cannot create %s (%s)" % (self.cache_dir, e))
+                self._disk_ok = False
+            if not self._disk_ok:
+                print("Storage: %s is not ours, not caching on disk" % self.cache_dir)
+        return self._disk_ok
+
+    def _on_disk(self, key):
+        return not key.startswith(SECRET_PREFIXES) and self._private_dir()
+
+    def _load_disk(self, key):
+        if not self._on_disk(key):
+            return None
+        path = self._path(key)
+        try:
+            with __builtin__.open(path + ".etag", "r") as f:  # type: ignore[attr-defined]
+                etag = f.read()
+            with __builtin__.open(path, "rb") as f:  # type: ignore[attr-defined]
+                return [f.read(), etag, 0, False]
+        except (IOError, OSError):
+            return None
+
+    def _save_disk(self, key, data, etag):
+        if not self._on_disk(key):
+            return
+        path = self._path(key)
+        try:
+            for name, content, mode in ((path, data, "wb"), (path + ".etag", etag or "", "w")):
+                with __builtin__.open(name + ".tmp", mode) as f:  # type: ignore[attr-defined]
+                    f.write(content)
+                os.rename(name + ".tmp", name)
+        except (IOError, OSError) as e:
+            print("Storage: cannot cache %s on disk (%s)" % (key, e))
+
+    def read(self, key):
+        """Return the bytes of an object. Raises requests.HTTPError when missing."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[3] or time.time() - entry[2] < self.max_age):
+                instrument.incr("storage_reads", result="memory")
+                return entry[0]
+            if entry is None:
+                entry = self._load_disk(key)
+            etag = entry[1] if entry is not None else None
+        data, etag = self._client_factory().get_object_if_changed(key, etag)
+        with self._lock:
+            current = self._entries.get(key)
+            if current is not None and current[3]:
+                # written while we were reading
+                return current[0]
+            if data is None:
+                instrument.incr("storage_reads", result="not_modified")
+                data = entry[0]
+            else:
+                instrument.incr("storage_reads", result="fetched")
+                self._save_disk(key, data, etag)
+            self._entries[key] = [data, etag, time.time(), False]
+            return data
+
+    def write(self, key, data):
+        """Store bytes; the upload happens within `flush_delay` seconds."""
+        instrument.incr("storage_writes")
+        with self._lock:
+            self._entries[key] = [data, None, time.time(), True]
+            if self._timer is None:
+                self._timer = threading.Timer(self.flush_delay, self._flush_later)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _flush_later(self):
+        try:
+            self.flush()
+        except StorageError as e:
+            # the writes stay pending for the next flush, which reports them to its caller
+            print("Storage: %s, kept for the next flush" % e)
+
+    def read_many(self, keys):
+        """Read several objects concurrently. Returns {key: bytes} without the missing ones.
+        Any other error, like a failed signature or a network error, is raised."""
+        def fetch(key):
+            try:
+                return self.read(key)
+            except Exception as e:
+                if is_missing(e):
+                    return None
+                raise
+
+        found = map_ordered(fetch, keys, concurrency=self.workers)
+        return dict((key, data) for key, data in zip(keys, found) if data is not None)
+
+    def write_many(self, items):
+        """Store several objects and upload them concurrently now."""
+        for key, data in items.items():
+            self.write(key, data)
+        self.flush()
+
+    def flush(self):
+        """Upload every pending write now, concurrently. Raises StorageError naming the keys that failed."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            pending = [(key, entry[0]) for key, entry in self._entries.items() if entry[3]]
+
+        def upload(item):
+            key, data = item
+            for attempt in range(self.retries + 1):
+                try:
+                    etag = self._client_factory().put_object(key, data, content_type="text/plain")
+                    break
+                except Exception as e:
+                    print("Storage: cannot upload %s (%s)" % (key, e))
+                    if attempt == self.retries:
+                        # stays dirty, the next flush tries again
+                        return key
+                    time.sleep(random.uniform(0, self.backoff * (2 ** attempt)))
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] is data:
+                    self._entries[key] = [data, etag, time.time(), False]
+                    self._save_disk(key, data, etag)
+            return None
+
+        failed = [key for key in map_ordered(upload, pending, concurrency=self.workers) if key is not None]
+        if failed:
+            raise StorageError(failed)
+
+
+store = TieredStore()
+atexit.register(store.flush)
+
+
+def flush():
+    """Upload pending writes now."""
+    store.flush()
+
+
 class _OSSFile:
     bucket = ""
     endpoint = ""
@@ -48,31 +286,16 @@ class _OSSFile:
     def __init__(self, filename, mode):
         self.filename = filename
         self.mode = mode
-        self.bucket, self.endpoint, self.access_key_id, self.access_key_secret = _oss_config()
 
     def read(self):
-        data = get_object(
-            bucket=self.bucket,
-            key=self.filename,
-            access_key_id=self.access_key_id,
-            access_key_secret=self.access_key_secret,
-            endpoint=self.endpoint,
-        )
+        data = store.read(self.filename)
         if "b" in self.mode:
             return data
         return data.decode("utf-8")
 
     def write(self, data):
         payload = data if isinstance(data, bytes) else str(data).encode("utf-8")
-        put_object(
-            bucket=self.bucket,
-            key=self.filename,
-            data=payload,
-            access_key_id=self.access_key_id,
-            access_key_secret=self.access_key_secret,
-            endpoint=self.endpoint,
-            content_type="text/plain",
-        )
+        store.write(self.filename, payload)
         return len(payload)
 
     def seek(self, offset):
@@ -111,3 +334,20 @@ def write_refresh_token(token, filename="refresh_token.txt"):
         _OSSFile(filename, "w").write(token)
         return
     _write_local(filename, token)
+
+
+def read_many(filenames):
+    """Read several keys at once. Returns {filename: text} without the missing ones."""
+    if _storage_mode() == "oss":
+        return dict((name, data.decode("utf-8")) for name, data in store.read_many(filenames).items())
+    return dict((name, _read_local(name)) for name in filenames if os.path.exists(name))
+
+
+def write_many(items):
+    """Write several {filename: text} at once."""
+    if _storage_mode() == "oss":
+        store.write_many(dict((name, data if isinstance(data, bytes) else str(data).encode("utf-8"))
+                              for name, data in items.items()))
+        return
+    for name, data in items.items():
+        _write_local(name, data)
@@ -0,0 +1,233 @@
+"""Long-running update service that keeps its state in memory between checks.
+
+Every `updateBillboard` run starts from nothing: it reads the token, the
+caches and the chart validators from storage, opens new connections and
+reads the cover image again. `UpdateService` keeps one `BillboardToSpotify`
+alive instead and checks the chart every `interval` seconds, reusing:
+
+- the access token, refreshed in the background shortly before it expires
+- the HTTP session and its pooled connections
+- the song cache, track index and aliases
+- the validators and hash of the last chart, so a check of an unchanged
+  chart is one conditional GET and nothing else
+- the cover image
+
+Each cycle runs `updateBillboardPlaylist` and then uploads pending storage
+writes. A small HTTP server on 127.0.0.1 triggers and reports cycles:
+
+    POST /sync          check the chart now
+    POST /sync?force=1  update the playlist even if the chart is unchanged
+    GET /status         state, counters, the last cycle with its timing
+                        summary, the next check, token expiry, cache sizes
+
+The credentials come from the environment (USER_ID, CLIENT_ID,
+CLIENT_SECRET, REDIRECT_URI) or else from api.json in storage, and are read
+once at start.
+
+Usage:
+    python service.py [--interval 3600] [--port 8765] [--host 127.0.0.1]
+    curl -X POST http://127.0.0.1:8765/sync
+    curl http://127.0.0.1:8765/status
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+
+import instrument
+import sae_patch
+from billboard_to_spotify import BillboardToSpotify, updateBillboardPlaylist
+from cli import pop_option
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, content):
+        body = json.dumps(content, indent=1, sort_keys=True).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urlparse(self.path).path != "/status":
+            return self._reply(404, {"error": "not found"})
+        self._reply(200, self.server.service.status())
+
+    def do_POST(self):
+        parsed = urlparse(self.path)
+        if parsed.path != "/sync":
+            return self._reply(404, {"error": "not found"})
+        force = parse_qs(parsed.query).get("force", ["0"])[0] not in ("0", "false")
+        self._reply(202, self.server.service.trigger(force))
+
+
+class UpdateService(object):
+    """Scheduled playlist updates of one BillboardToSpotify with a local control endpoint."""
+
+    def __init__(self, billboard_playlist, interval=3600, sync=True, host="127.0.0.1", port=8765):
+        self.playlist = billboard_playlist
+        self.interval = interval
+        self.sync = sync
+        self.address = (host, port)
+        self.state = "stopped"
+        self.cycles = 0
+        self.updates = 0
+        self.failures = 0
+        # result of the last cycle: started, seconds, updated or error, summary
+        self.last = None
+        self.next_check = None
+        self._force = False
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._server = None
+        self._threads = []
+
+    def trigger(self, force=False):
+        """Run a cycle as soon as the current one, if any, is done."""
+        with self._lock:
+            self._force = self._force or force
+        self._wake.set()
+        return {"triggered": True, "force": force, "state": self.state}
+
+    def run_cycle(self, force=False):
+        """Check the chart and update the playlist once. Returns the cycle's result."""
+        instrument.recorder.reset()
+        self.state = "running"
+        begin = time.time()
+        result = {"started": begin, "force": force}
+        try:
+            # nobody can paste an authorization code on the loop thread, the cycle fails instead
+            result["updated"] = updateBillboardPlaylist(self.playlist, self.sync, force, interactive=False)
+            sae_patch.flush()
+        except Exception as e:
+            result["error"] = "%s: %s" % (type(e).__name__, e)
+            print("Service: cycle failed (%s)" % result["error"])
+        result["seconds"] = round(time.time() - begin, 3)
+        result["summary"] = instrument.recorder.summary()
+        print(result["summary"])
+        self.cycles += 1
+        if result.get("updated"):
+            self.updates += 1
+        if "error" in result:
+            self.failures += 1
+        self.last = result
+        self.state = "idle"
+        return result
+
+    def _loop(self):
+        while not self._stopping.is_set():
+            # cleared before the cycle, so a trigger during it runs another one right after
+            self._wake.clear()
+            with self._lock:
+                force, self._force = self._force, False
+            self.run_cycle(force)
+            self.next_check = time.time() + self.interval
+            self._wake.wait(self.interval)
+
+    def status(self):
+        """Return the service state as a JSON-serializable dict."""
+        playlist = self.playlist
+        return {
+            "state": self.state,
+            "interval": self.interval,
+            "cycles": self.cycles,
+            "updates": self.updates,
+            "failures": self.failures,
+            "last": self.last,
+            "next_check": self.next_check,
+            "token_expires_in": playlist.tokens.expires_in(),
+            "song_cache": len(playlist.cache) if playlist.cache is not None else None,
+            "track_index": len(playlist.index) if playlist.index is not None else None,
+            "aliases": len(playlist.aliases) if playlist.aliases is not None else None,
+        }
+
+    @property
+    def url(self):
+        return "http://%s:%d" % self._server.server_address[:2]
+
+    def start(self):
+        """Start the control endpoint and the schedule; the first cycle runs right away."""
+        self.playlist.tokens.start_auto_refresh()
+        self._server = _Server(self.address, _Handler)
+        self._server.service = self
+        self.state = "idle"
+        self._threads = [threading.Thread(target=self._server.serve_forever), threading.Thread(target=self._loop)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+        print("Service: listening on %s, checking every %ds" % (self.url, self.interval))
+        return self
+
+    def stop(self):
+        """Stop after the current cycle and upload pending storage writes."""
+        self._stopping.set()
+        self._wake.set()
+        self._server.shutdown()
+        self._server.server_close()
+        for thread in self._threads:
+            thread.join()
+        self.playlist.tokens.stop_auto_refresh()
+        sae_patch.flush()
+        self.state = "stopped"
+
+    def serve_forever(self):
+        """Run until interrupted with Ctrl-C."""
+        self.start()
+        try:
+            while self._threads[1].is_alive():
+                self._threads[1].join(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+
+def load_credentials():
+    """Return (USER_ID, CLIENT_SECRET, CLIENT_ID, REDIRECT_URI) from the environment or api.json."""
+    if os.environ.get("USER_ID"):
+        content = os.environ
+    else:
+        content = json.loads(sae_patch.read_refresh_token("api.json"))
+    return (content["USER_ID"], content["CLIENT_SECRET"], content["CLIENT_ID"],
+            content.get("REDIRECT_URI", "https://example.com"))
+
+
+def main(argv):
+    argv = list(argv)
+    interval = int(pop_option(argv, "--interval", "3600"))
+    port = int(pop_option(argv, "--port", "8765"))
+    host = pop_option(argv, "--host", "127.0.0.1")
+    if argv:
+        raise SystemExit(__doc__)
+    USER_ID, CLIENT_SECRET, CLIENT_ID, REDIRECT_URI = load_credentials()
+    billboard_playlist = BillboardToSpotify(user_id=USER_ID, client_secret=CLIENT_SECRET, client_id=CLIENT_ID,
+                                            redirect_uri=REDIRECT_URI)
+    UpdateService(billboard_playlist, interval=interval, host=host, port=port).serve_forever()
+
+
+__all__ = ["UpdateService", "load_credentials"]
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,130 @@
+"""Persistent cache of Spotify search results for chart songs.
+
+Entries are keyed by the normalized song string produced by
+`BillboardToSpotify.billboard_top_100` and hold the resolved track URI, or
+None when the search found nothing. The cache is stored as one JSON document
+through `sae_patch`, so it lives on local disk or in OSS depending on the
+storage mode.
+
+- Positive results expire after `ttl` seconds, negative ones after
+  `negative_ttl` seconds, so songs that were missing get searched again sooner.
+- At most `max_entries` entries are kept; the least recently used are dropped
+  when the cache is saved.
+
+Example:
+    cache = SongCache("song_cache.json")
+    cache.load()
+    found, uri = cache.lookup("Flowers artist:Miley Cyrus")
+    if not found:
+        cache.put("Flowers artist:Miley Cyrus", "spotify:track:...")
+    cache.save()
+"""
+
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import instrument
+import sae_patch
+
+
+def normalize_key(song):
+    """Return the cache key for a formatted song string."""
+    return u" ".join(song.split()).lower()
+
+
+class SongCache(object):
+    """Thread-safe TTL/LRU cache of song -> track URI persisted as JSON."""
+
+    def __init__(
+        self,
+        filename="song_cache.json",
+        ttl=7 * 24 * 3600,
+        negative_ttl=24 * 3600,
+        max_entries=5000,
+        reader=None,
+        writer=None,
+    ):
+        self.filename = filename
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._read = reader or sae_patch.read_refresh_token
+        self._write = writer or sae_patch.write_refresh_token
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._dirty = False
+        self.hits = 0
+        self.misses = 0
+
+    def load(self):
+        """Load entries from storage. A missing or broken file starts empty."""
+        try:
+            content = self._read(self.filename)
+            entries = json.loads(content)["entries"] if content else []
+        except Exception as e:
+            print("Cache: cannot load %s (%s)" % (self.filename, e))
+            entries = []
+        with self._lock:
+            self._entries.clear()
+            for key, uri, stored_at in entries:
+                self._entries[key] = (uri, stored_at)
+            self._dirty = False
+        return self
+
+    def _expired(self, uri, stored_at, now):
+        ttl = self.ttl if uri is not None else self.negative_ttl
+        return ttl is not None and now - stored_at > ttl
+
+    def lookup(self, song):
+        """Return (found, uri). `found` is False for unknown or expired songs."""
+        key = normalize_key(song)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or self._expired(entry[0], entry[1], time.time()):
+                self.misses += 1
+                instrument.incr("cache_lookups", cache=self.filename, result="miss")
+                return False, None
+            # move to the most recently used end
+            del self._entries[key]
+            self._entries[key] = entry
+            self.hits += 1
+            instrument.incr("cache_lookups", cache=self.filename, result="hit")
+            return True, entry[0]
+
+    def put(self, song, uri):
+        """Store the search result for a song; `uri` may be None."""
+        key = normalize_key(song)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (uri, time.time())
+            self._dirty = True
+
+    def prune(self):
+        """Drop expired entries, then the least recently used over the limit."""
+        now = time.time()
+        with self._lock:
+            for key in [k for k, (uri, stored_at) in self._entries.items()
+                        if self._expired(uri, stored_at, now)]:
+                del self._entries[key]
+                self._dirty = True
+            while self.max_entries and len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._dirty = True
+
+    def save(self):
+        """Write the cache back to storage if anything changed."""
+        self.prune()
+        with self._lock:
+            if not self._dirty:
+                return
+            entries = [[key, uri, stored_at] for key, (uri, stored_at) in self._entries.items()]
+            self._dirty = False
+        self._write(json.dumps({"version": 1, "entries": entries}), self.filename)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+__all__ = ["SongCache", "normalize_key"]
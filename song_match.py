@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""Matching of Spotify search results against chart songs.
+
+`query_song_uri` used to take the first search result and, when there was
+none, search again without the artist. This module scores every returned
+candidate instead:
+
+- Titles and artists are normalized: unicode is decomposed and accents
+  dropped, case and punctuation ignored, "&" read as "and", "×" as "x", and
+  "(feat. ...)"-style credits and " - Remastered"-style suffixes stripped from
+  titles.
+- A candidate scores by title similarity (difflib) and by how many of its
+  credited artists' names appear in the chart artist. When the chart names
+  an artist, a candidate crediting none of it scores 0, however well the
+  title matches. The best candidate is taken when it scores at least
+  `ACCEPT_SCORE`; a weaker one only when the fallback queries find nothing
+  better.
+- `REWRITES` fixes spellings the search does not find, like "4x4xU".
+- `AliasTable` keeps per-song overrides as JSON through `sae_patch`: a query
+  to search first and/or the track uri to use. Songs that only matched on a
+  fallback query, with at least `ACCEPT_SCORE`, are learned into it, so the
+  next run needs one request. Entries added by hand (without "learned") are
+  never replaced. Learned entries of files older than `ALIAS_VERSION`, which
+  may hold title-only matches, are dropped on load.
+
+Example:
+    title, artist = split_song("Flowers artist:Miley Cyrus")
+    score, track = best_match(title, artist, response["tracks"]["items"])
+    if score >= ACCEPT_SCORE:
+        uri = track["uri"]
+"""
+
+import difflib
+import json
+import re
+import threading
+import unicodedata
+
+import sae_patch
+
+ACCEPT_SCORE = 0.8
+MIN_SCORE = 0.5
+# version 1 learned matches without artist overlap
+ALIAS_VERSION = 2
+
+# query spellings the search does not match, fixed before searching
+REWRITES = [
+    (u"4x4xU", u"4×4×U"),
+]
+
+_APOSTROPHES = re.compile(u"['‘’`]")
+_PUNCTUATION = re.compile(r"[^\w\s]", re.UNICODE)
+_TITLE_CREDITS = re.compile(r"\s*[\(\[](feat\.?|ft\.?|featuring|with|from)\s[^\)\]]*[\)\]]", re.IGNORECASE | re.UNICODE)
+_TITLE_SUFFIX = re.compile(r"\s+-\s+.*$", re.UNICODE)
+_ARTIST_WORDS = frozenset([u"and", u"x", u"with", u"feat", u"ft", u"featuring", u"the"])
+
+
+def _text(text):
+    if isinstance(text, bytes):
+        return text.decode("utf-8")
+    return text
+
+
+def normalize(text):
+    """Return lowercase ASCII-folded words of `text` joined by single spaces."""
+    text = unicodedata.normalize("NFKD", _text(text))
+    text = u"".join(c for c in text if not unicodedata.combining(c)).lower()
+    text = text.replace(u"×", u"x").replace(u"&", u" and ").replace(u"$", u"s")
+    text = _PUNCTUATION.sub(u" ", _APOSTROPHES.sub(u"", text))
+    return u" ".join(text.split())
+
+
+def clean_title(title):
+    """Return the normalized title without featuring credits and dash suffixes."""
+    title = _TITLE_SUFFIX.sub(u"", _TITLE_CREDITS.sub(u"", _text(title)))
+    return normalize(title)
+
+
+def artist_words(artist):
+    """Return the set of normalized words of an artist credit, without joining words."""
+    return set(normalize(artist).split()) - _ARTIST_WORDS
+
+
+def split_song(song):
+    """Return (title, artist) of a formatted song string."""
+    song = _text(song)
+    index = song.find(u"artist:")
+    if index < 0:
+        return song.strip(), u""
+    return song[:index].strip(), song[index + len(u"artist:"):].strip()
+
+
+def rewrite(query):
+    """Apply REWRITES to a search query."""
+    for wrong, right in REWRITES:
+        query = query.replace(wrong, right)
+    return query
+
+
+def match_key(song):
+    """Return the alias table key of a formatted song: its cleaned title and artist words."""
+    title, artist = split_song(song)
+    return u"%s|%s" % (clean_title(title), u" ".join(sorted(artist_words(artist))))
+
+
+def score(title, artist, track):
+    """Return how well a Spotify track object matches a chart title and artist, from 0 to 1."""
+    wanted, found = clean_title(title), clean_title(track.get("name", u""))
+    if wanted == found:
+        title_score = 1.0
+    else:
+        title_score = max(difflib.SequenceMatcher(None, wanted, found).ratio(),
+                          difflib.SequenceMatcher(None, normalize(title), normalize(track.get("name", u""))).ratio())
+    wanted_words = artist_words(artist)
+    if not wanted_words:
+        return title_score
+    credited = [artist_words(a.get("name", u"")) for a in track.get("artists", [])]
+    credited = [words for words in credited if words]
+    if not set().union(*credited) & wanted_words:
+        # same title by someone else
+        return 0.0
+    # the best credited artist found in the chart artist, and how much of the chart artist is credited
+    best = max(float(len(words & wanted_words)) / len(words) for words in credited)
+    coverage = float(len(set().union(*credited) & wanted_words)) / len(wanted_words)
+    return 0.6 * title_score + 0.4 * (0.5 * best + 0.5 * coverage)
+
+
+def best_match(title, artist, tracks):
+    """Return (score, track) of the best scoring track, the earliest one on ties; (0, None) for none."""
+    best = (0.0, None)
+    for track in tracks:
+        if not track:
+            continue
+        value = score(title, artist, track)
+        if value > best[0]:
+            best = (value, track)
+    return best
+
+
+class AliasTable(object):
+    """Thread-safe per-song search overrides persisted as JSON."""
+
+    def __init__(self, filename="aliases.json", reader=None, writer=None):
+        self.filename = filename
+        self._read = reader or sae_patch.read_refresh_token
+        self._write = writer or sae_patch.write_refresh_token
+        self._aliases = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+
+    def load(self):
+        """Load aliases from storage. A missing or broken file starts empty."""
+        try:
+            content = self._read(self.filename)
+            saved = json.loads(content) if content else {}
+        except Exception as e:
+            print("Aliases: cannot load %s (%s)" % (self.filename, e))
+            saved = {}
+        aliases = saved.get("aliases", {})
+        dirty = False
+        if saved.get("version", ALIAS_VERSION) < ALIAS_VERSION:
+            kept = dict((key, entry) for key, entry in aliases.items() if not entry.get("learned"))
+            dirty = len(kept) != len(aliases)
+            aliases = kept
+        with self._lock:
+            self._aliases = aliases
+            self._dirty = dirty
+        return self
+
+    def get(self, song):
+        """Return the alias of a formatted song, a dict with "query" and/or "uri", or None."""
+        with self._lock:
+            return self._aliases.get(match_key(song))
+
+    def learn(self, song, query, uri):
+        """Remember the query and uri a song matched with, unless it has a hand-made alias."""
+        key = match_key(song)
+        with self._lock:
+            current = self._aliases.get(key)
+            if current is not None and not current.get("learned"):
+                return
+            entry = {"query": query, "uri": uri, "learned": True}
+            if current != entry:
+                self._aliases[key] = entry
+                self._dirty = True
+
+    def forget(self, song):
+        """Drop the learned alias of a song, e.g. when its track is no longer available."""
+        key = match_key(song)
+        with self._lock:
+            current = self._aliases.get(key)
+            if current is not None and current.get("learned"):
+                del self._aliases[key]
+                self._dirty = True
+
+    def save(self):
+        """Write the aliases back to storage if anything changed."""
+        with self._lock:
+            if not self._dirty:
+                return
+            content = json.dumps({"version": ALIAS_VERSION, "aliases": self._aliases}, indent=1, separators=(",", ": "), sort_keys=True)
+            self._dirty = False
+        self._write(content, self.filename)
+
+    def __len__(self):
+        return len(self._aliases)
+
+
+__all__ = [
+    "ACCEPT_SCORE",
+    "ALIAS_VERSION",
+    "MIN_SCORE",
+    "REWRITES",
+    "AliasTable",
+    "best_match",
+    "clean_title",
+    "match_key",
+    "normalize",
+    "rewrite",
+    "score",
+    "split_song",
+]
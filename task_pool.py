@@ -0,0 +1,98 @@
+"""Bounded worker pool that maps a function over items and keeps input order.
+
+The runtime this project targets is Python 2.7, so there is no asyncio; the
+HTTP calls are blocking `requests` calls anyway. The pool gives the same
+guarantees an event-loop engine would:
+
+- At most `concurrency` calls run at once, and items are pulled from the input
+  iterator lazily, so a generator of large items stays bounded in memory.
+- Results come back in input order, whatever order the calls finish in.
+- An exception in any call cancels the remaining work and is re-raised to the
+  caller instead of leaving it waiting forever.
+- A call running longer than `task_timeout` seconds raises `TaskTimeout`.
+  Python threads cannot be killed, so the stuck call is abandoned on its
+  daemon thread and its result is discarded.
+- Closing the generator returned by `imap_ordered` cancels pending items.
+
+Example:
+    from task_pool import map_ordered
+
+    uris = map_ordered(query, songs, concurrency=10, task_timeout=60)
+"""
+
+import threading
+import time
+
+
+class TaskTimeout(Exception):
+    """Raised when a single call exceeds the pool's task timeout."""
+
+
+def imap_ordered(func, items, concurrency=10, task_timeout=None):
+    """Yield func(item) for every item, in input order."""
+    source = iter(enumerate(items))
+    source_lock = threading.Lock()
+    cond = threading.Condition()
+    cancelled = threading.Event()
+    results = {}
+    started = {}
+    state = {"alive": 0}
+
+    def worker():
+        try:
+            while not cancelled.is_set():
+                with source_lock:
+                    try:
+                        index, item = next(source)
+                    except StopIteration:
+                        return
+                with cond:
+                    started[index] = time.time()
+                try:
+                    outcome = (True, func(item))
+                except Exception as e:
+                    outcome = (False, e)
+                with cond:
+                    started.pop(index, None)
+                    results[index] = outcome
+                    cond.notify_all()
+        finally:
+            with cond:
+                state["alive"] -= 1
+                cond.notify_all()
+
+    state["alive"] = concurrency
+    for _ in range(concurrency):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+
+    next_index = 0
+    try:
+        while True:
+            with cond:
+                while next_index not in results:
+                    if state["alive"] == 0:
+                        return
+                    if task_timeout is not None:
+                        now = time.time()
+                        for index, begin in started.items():
+                            if now - begin > task_timeout:
+                                raise TaskTimeout("task %d exceeded %ss" % (index, task_timeout))
+                    # short waits keep Ctrl-C and timeouts responsive on Python 2
+                    cond.wait(0.2)
+                ok, value = results.pop(next_index)
+            if not ok:
+                raise value
+            yield value
+            next_index += 1
+    finally:
+        cancelled.set()
+
+
+def map_ordered(func, items, concurrency=10, task_timeout=None):
+    """Return [func(item) for item in items], computed by a bounded pool."""
+    return list(imap_ordered(func, items, concurrency, task_timeout))
+
+
+__all__ = ["TaskTimeout", "imap_ordered", "map_ordered"]
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""Tests for the chart_parser backends on the chart page in fixtures/.
+
+fixtures/hot-100.html reproduces the markup of billboard.com's Hot 100 page,
+trimmed to 100 rows: the full class lists and tab/newline padding, HTML
+entities, NEW and RE- ENTRY badges, lazy images, svg icons, the hidden chart
+history of every row, and `h3#title-of-a-story` article teasers before and
+after the chart list. When the site changes, record the page again with
+`curl -o fixtures/hot-100.html https://www.billboard.com/charts/hot-100/`
+and update the expected rows below.
+
+Run with `python -m unittest test_chart_parser`.
+"""
+
+import io
+import os
+import unittest
+
+from chart_parser import BACKENDS, format_song, parse_stream
+
+try:
+    import bs4
+except ImportError:
+    bs4 = None
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "hot-100.html")
+
+
+def read_fixture():
+    with io.open(FIXTURE, encoding="utf-8") as f:
+        return f.read()
+
+
+class ChartParserTest(unittest.TestCase):
+    def setUp(self):
+        self.html = read_fixture()
+
+    def test_stream_reads_every_chart_row(self):
+        songs = [format_song(title, artist) for title, artist in parse_stream(self.html)]
+        self.assertEqual(len(songs), 100)
+        self.assertEqual(songs[0], u"Lovin On Me artist:Jack Harlow")
+        # format_song leaves two spaces where "Featuring" was
+        self.assertEqual(songs[6], u"I Remember Everything artist:Zach Bryan  Kacey Musgraves")
+        # entities are decoded, teasers outside the chart list are not rows
+        self.assertEqual(songs[9], u"Is It Over Now? (Taylor's Version) [From The Vault] artist:Taylor Swift")
+        self.assertEqual(songs[17], u"Rich Baby Daddy artist:Drake  Sexyy Red & SZA")
+        self.assertFalse([song for song in songs if "Chart Beat" in song])
+
+    def test_stream_of_a_page_without_rows(self):
+        self.assertEqual(parse_stream(u"<html><body><h3 id=\"title-of-a-story\">News</h3></body></html>"), [])
+
+    @unittest.skipIf(bs4 is None, "the soup backends need bs4")
+    def test_backends_agree(self):
+        reference = BACKENDS["soup"](self.html)
+        self.assertEqual(len(reference), 100)
+        for name, parse in sorted(BACKENDS.items()):
+            self.assertEqual(parse(self.html), reference, name)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+"""Tests for playlist_sync.plan_sync.
+
+Every plan is checked by applying it the way the Spotify endpoints do, in
+order: removals, then reorders, then inserts.
+
+Run with `python -m unittest test_playlist_sync`.
+"""
+
+import random
+import unittest
+
+from playlist_sync import plan_requests, plan_sync, replace_requests
+
+
+def apply_plan(current, plan):
+    removals, moves, inserts = plan
+    tracks = list(current)
+    for uri, position in removals:
+        assert tracks[position] == uri
+        del tracks[position]
+    for range_start, insert_before, range_length in moves:
+        # PUT /tracks: insert_before counts positions before the range is taken out
+        assert not range_start <= insert_before <= range_start + range_length
+        block = tracks[range_start:range_start + range_length]
+        del tracks[range_start:range_start + range_length]
+        position = insert_before - range_length if insert_before > range_start else insert_before
+        tracks[position:position] = block
+    for position, uris in inserts:
+        tracks[position:position] = uris
+    return tracks
+
+
+class PlanSyncTest(unittest.TestCase):
+    def check(self, current, target, chunk=100):
+        plan = plan_sync(current, target, chunk)
+        self.assertEqual(apply_plan(current, plan), target)
+        return plan
+
+    def test_docstring_example(self):
+        plan = self.check(["a", "b", "c"], ["c", "a", "d"])
+        self.assertEqual(plan, ([("b", 1)], [(0, 2, 1)], [(2, ["d"])]))
+
+    def test_unchanged_playlist_needs_nothing(self):
+        self.assertEqual(self.check(list("abcdef"), list("abcdef")), ([], [], []))
+
+    def test_empty_playlists(self):
+        self.assertEqual(self.check([], []), ([], [], []))
+        self.assertEqual(self.check([], list("abc")), ([], [], [(0, ["a", "b", "c"])]))
+        removals, moves, inserts = self.check(list("abc"), [])
+        self.assertEqual(removals, [("c", 2), ("b", 1), ("a", 0)])
+
+    def test_removals_go_from_the_end(self):
+        removals, _, _ = self.check(list("abcde"), list("ace"))
+        self.assertEqual(removals, [("d", 3), ("b", 1)])
+
+    def test_moves_are_minimal(self):
+        # one track out of place needs one move
+        _, moves, _ = self.check(list("abcdef"), list("bcdefa"))
+        self.assertEqual(len(moves), 1)
+        _, moves, _ = self.check(list("abcdef"), list("fedcba"))
+        self.assertEqual(len(moves), 5)
+
+    def test_neighbours_move_as_one_range(self):
+        _, moves, _ = self.check(list("efghabcd"), list("abcdefgh"))
+        self.assertEqual(len(moves), 1)
+        self.assertEqual(moves[0][2], 4)
+        _, moves, _ = self.check(list("abxcdyef"), list("xyabcdef"))
+        self.assertEqual([length for _, _, length in moves], [1, 1])
+
+    def test_weekly_chart_change_is_cheap_or_replaced(self):
+        rng = random.Random(5)
+        current = ["last%d" % i for i in range(100)]
+        target = sorted(current[:90], key=lambda uri: current.index(uri) + rng.gauss(0, 5))
+        for i in range(10):
+            target.insert(rng.randint(0, len(target)), "new%d" % i)
+        plan = self.check(current, target)
+        # a reshuffled chart costs more than one PUT of all tracks, so the sync replaces it
+        self.assertTrue(plan_requests(plan) > replace_requests(len(target)))
+        self.assertEqual(replace_requests(100), 1)
+        self.assertEqual(replace_requests(250), 3)
+        self.assertEqual(plan_requests(self.check(current, current[1:] + ["new"])), 2)
+
+    def test_inserts_are_chunked_in_order(self):
+        target = ["new%d" % i for i in range(250)]
+        _, _, inserts = self.check([], target, chunk=100)
+        self.assertEqual([(position, len(uris)) for position, uris in inserts], [(0, 100), (100, 100), (200, 50)])
+
+    def test_repeated_uris(self):
+        self.check(["a", "b", "a", "c"], ["a", "c", "a"])
+        self.check(["a", "a"], ["a", "b", "a", "a"])
+        self.check(["x", "a", "x"], ["a", "x"])
+
+    def test_random_plans(self):
+        rng = random.Random(7)
+        pool = ["spotify:track:%d" % i for i in range(30)]
+        for _ in range(300):
+            current = [rng.choice(pool) for _ in range(rng.randint(0, 40))]
+            target = [rng.choice(pool) for _ in range(rng.randint(0, 40))]
+            self.check(current, target, chunk=rng.randint(1, 10))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,126 @@
+"""Spotify access token kept across runs and refreshed shortly before expiry.
+
+`TokenManager` holds the access token and the time it expires, in memory and
+as JSON through `sae_patch`, so a run started while the previous token is
+still valid skips the accounts.spotify.com round trip and the refresh token
+read/write altogether.
+
+- `get()` is thread-safe; when the token is within `margin` seconds of expiry
+  the first caller refreshes it and the others wait for the new one.
+- `start_auto_refresh()` refreshes in a daemon timer thread `margin` seconds
+  before expiry, so long batch jobs never block on a refresh.
+
+Example:
+    tokens = TokenManager(refresh).load()
+    if not tokens.valid():
+        tokens.set(*refresh())
+    headers = {"Authorization": "Bearer " + tokens.get()}
+
+`refresh` returns (access_token, expires_in), or None when it cannot refresh.
+"""
+
+import json
+import threading
+import time
+
+import sae_patch
+
+
+class TokenManager(object):
+    """Access token with expiry, persisted through sae_patch."""
+
+    def __init__(self, refresh, filename="access_token.json", margin=300, reader=None, writer=None):
+        self.refresh = refresh
+        self.filename = filename
+        self.margin = margin
+        self._read = reader or sae_patch.read_refresh_token
+        self._write = writer or sae_patch.write_refresh_token
+        self._token = ""
+        self._expires_at = None
+        self._lock = threading.RLock()
+        self._timer = None
+        self._auto = False
+
+    def load(self):
+        """Load the saved token. A missing or broken file leaves it empty."""
+        try:
+            content = self._read(self.filename)
+            saved = json.loads(content) if content else {}
+        except Exception as e:
+            print("Token: cannot load %s (%s)" % (self.filename, e))
+            saved = {}
+        with self._lock:
+            self._token = saved.get("access_token", "")
+            self._expires_at = saved.get("expires_at")
+            # a token loaded after start_auto_refresh is refreshed in the background too
+            self._schedule()
+        return self
+
+    def expires_in(self):
+        """Seconds until the token expires, None when unknown."""
+        if self._expires_at is None:
+            return None
+        return self._expires_at - time.time()
+
+    def valid(self):
+        """Return True when the token exists and is not about to expire."""
+        remaining = self.expires_in()
+        return bool(self._token) and remaining is not None and remaining > self.margin
+
+    def set(self, token, expires_in=None, save=True):
+        """Replace the token; with `expires_in` it is saved and refreshed before expiry."""
+        with self._lock:
+            self._token = token
+            self._expires_at = time.time() + expires_in if expires_in else None
+            if save and expires_in:
+                self._write(json.dumps({"access_token": token, "expires_at": self._expires_at}), self.filename)
+            self._schedule()
+
+    def _refresh(self):
+        refreshed = self.refresh()
+        if refreshed:
+            self.set(*refreshed)
+        return refreshed
+
+    def get(self):
+        """Return the token, refreshing it first when it is about to expire."""
+        if self._token and self._expires_at is not None and not self.valid():
+            with self._lock:
+                if not self.valid():
+                    self._refresh()
+        return self._token
+
+    def _schedule(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        remaining = self.expires_in()
+        if not self._auto or remaining is None:
+            return
+        # a failed refresh is retried every 30 seconds
+        self._timer = threading.Timer(max(remaining - self.margin, 30), self._on_timer)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _on_timer(self):
+        with self._lock:
+            try:
+                if not self.valid() and not self._refresh():
+                    print("Token: background refresh failed")
+            except Exception as e:
+                print("Token: background refresh failed (%s)" % e)
+            self._schedule()
+
+    def start_auto_refresh(self):
+        """Refresh the token in the background shortly before it expires."""
+        with self._lock:
+            self._auto = True
+            self._schedule()
+
+    def stop_auto_refresh(self):
+        with self._lock:
+            self._auto = False
+            self._schedule()
+
+
+__all__ = ["TokenManager"]